@@ -15,8 +15,8 @@
 from collections import namedtuple
 
 __all__ = [
-    'Packer', 'Unpacker', 'ExtType',
-    'pack', 'packb', 'unpack', 'unpackb',
+    'Packer', 'Unpacker', 'ExtType', 'LazyStr', 'Raw',
+    'pack', 'packb', 'unpack', 'unpackb', 'encoded_size',
     'dump', 'dumps', 'load', 'loads'
 ]
 
@@ -32,17 +32,72 @@ class ExtType(namedtuple('ExtType', ['code', 'data'])):
         return super(ExtType, cls).__new__(cls, code, data)
 
 
-from ._fallback import Packer, Unpacker, unpack, unpackb
+class Raw(namedtuple('Raw', ['data', 'span'])):
+    """An object that's already Mashpack-encoded. ``Packer`` writes ``data``
+    verbatim. When returned by ``Unpacker`` the ``span`` is the ``(start, end)``
+    offset of the object within the stream.
+    """
+    def __new__(cls, data, span=None):
+        if not isinstance(data, (bytes, memoryview)):
+            raise TypeError('data must be bytes or memoryview')
+        return super(Raw, cls).__new__(cls, data, span)
+
+
+class LazyStr(object):
+    """A ``STR`` value that holds onto its UTF-8 encoded bytes and is only
+    decoded the first time it's used as a ``str``. ``Packer`` writes the
+    original bytes back out without decoding them.
+    """
+    __slots__ = ('data', '_value')
+
+    def __init__(self, data):
+        if not isinstance(data, bytes):
+            raise TypeError('data must be bytes')
+        self.data = data
+        self._value = None
+
+    def __str__(self):
+        if self._value is None:
+            self._value = self.data.decode('utf-8')
+        return self._value
+
+    def __repr__(self):
+        return f'LazyStr({str(self)!r})'
+
+    def __eq__(self, other):
+        if isinstance(other, LazyStr):
+            return self.data == other.data
+        elif isinstance(other, str):
+            return str(self) == other
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __len__(self):
+        return len(str(self))
+
+
+from ._fallback import Packer, Unpacker, unpack, unpackb, encoded_size, _pool_acquire, _pool_release
 
 
 def pack(o, stream, **kwargs):
-    packer = Packer(**kwargs)
-    stream.write(packer.pack(o))
+    stream.write(packb(o, **kwargs))
 
 
 def packb(o, **kwargs) -> bytes:
-    packer = Packer(**kwargs)
-    return packer.pack(o)
+    """Packs ``o`` into bytes. Unlike ``Packer`` this is safe to call
+    from multiple threads at once, each thread reuses its own ``Packer``
+    for options that are all hashable.
+    """
+    key, packer = _pool_acquire(Packer, kwargs)
+    if packer is None:
+        packer = Packer(**kwargs)
+    try:
+        return packer.pack(o)
+    finally:
+        if key is not None:
+            _pool_release(key, packer)
 
 
 # Compatibility with marshal/pickle
@@ -13,11 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import array
+import itertools
+import operator
 import struct
 import sys
+import threading
 import typing
 from mashpack.exceptions import OutOfData, BufferFull, PackValueError, ExtraData
-from mashpack import ExtType
+from mashpack import ExtType, LazyStr, Raw
 
 if hasattr(sys, 'pypy_version_info'):
     from __pypy__ import newlist_hint
@@ -41,6 +45,9 @@ if hasattr(sys, 'pypy_version_info'):
         def getvalue(self):
             return self.builder.build()
 
+        def tell(self):
+            return self.builder.getlength()
+
     _USING_BYTESBUILDER = True
 else:
     from io import BytesIO
@@ -49,7 +56,11 @@ else:
 
 
 _DEFAULT_MAX_LEN = 2**31-1
+_MIN_READ_BUFFER_SIZE = 1 << 12
 _DEFAULT_NEST_LIMIT = 511
+_CANONICAL_KEY_CACHE_SIZE = 1024
+_POOL_SIZE = 16
+_POOL_MAX_BUFFER_SIZE = 1 << 20
 
 _TYPE_IMMEDIATE = 0
 _TYPE_MAP = 1
@@ -75,11 +86,219 @@ _STRUCT_ARRAY32 = struct.Struct('>IB')
 _STRUCT_EXT8 = struct.Struct('>BB')
 _STRUCT_EXT16 = struct.Struct('>HB')
 _STRUCT_EXT32 = struct.Struct('>IB')
+_STRUCT_DELTA = struct.Struct('>IqqB')
+_STRUCT_NULLABLE = struct.Struct('>Ic')
+_NULLABLE_CODES = frozenset(b'bhiqBHIQfd')
+_DICTIONARY_CODES = frozenset(b'BHI')
+
+# Extension codes with the most significant bit set are reserved by Mashpack.
+_EXT_REF = 0x80
+_EXT_COLUMNAR = 0x81
+_EXT_DELTA = 0x82
+_EXT_BITMAP = 0x83
+_EXT_NULLABLE = 0x84
+_EXT_DICTIONARY = 0x85
+_EXT_DATETIME = 0x86
+_EXT_DECIMAL = 0x87
+_EXT_UUID = 0x88
+
+_DELTA_MIN_LEN = 4
+_DELTA_WIDTHS = ((0, ''), (0xFF, 'B'), (0xFFFF, 'H'), (0xFFFFFFFF, 'I'), (0xFFFFFFFFFFFFFFFF, 'Q'))
+_DELTA_CODES = {struct.calcsize(code): code for _, code in _DELTA_WIDTHS}
+
+_FLOAT32_ARRAY_MIN_LEN = 4
+_TYPED_ARRAY_CODES = {
+    0xD1: 'b', 0xD2: 'h', 0xD3: 'i', 0xD4: 'q',
+    0xD5: 'B', 0xD6: 'H', 0xD7: 'I', 0xD8: 'Q',
+    0xD9: 'f', 0xDA: 'd',
+}
+_TYPED_COLUMN_CODES = frozenset(''.join(_TYPED_ARRAY_CODES.values()).encode('ascii'))
+
+_BITMAP_MIN_LEN = 8
+_DICTIONARY_MIN_LEN = 4
+_BITS_TO_ASCII = bytes.maketrans(b'\x00\x01', b'01')
+_BYTE_TO_BITS = [tuple(bool(b >> i & 1) for i in range(8)) for b in range(256)]
+
+_COLUMNAR_LAYOUTS = ('rows', 'lists', 'arrays', 'ndarray')
 
 _CMD_SKIP = 0
 _CMD_CONSTRUCT = 1
 _CMD_READ_ARRAY_HEADER = 2
 _CMD_READ_MAP_HEADER = 3
+_CMD_CONSTRUCT_KEY = 4
+# Constructs an array without list_hook as it's only used internally.
+_CMD_CONSTRUCT_LIST = 5
+
+_QUERY_OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, expected: value in expected,
+}
+_QUERY_NO_MATCH = object()
+_NO_CLASS = object()
+
+
+def _query_raw_in(raw, expected):
+    return bytes(raw) in expected
+
+
+def _float32_exact(obj):
+    try:
+        return _STRUCT_FLOAT32.unpack(_STRUCT_FLOAT32.pack(obj))[0] == obj
+    except OverflowError:
+        return False
+
+
+def _typed_column_code(column):
+    # Returns the struct code for packing the values of a column as a
+    # typed array of integers or floats or None if they can't be.
+    if all(type(x) is float for x in column):
+        return 'd'
+    elif not all(type(x) is int for x in column):
+        return None
+    low, high = min(column), max(column)
+    if low >= 0:
+        for code, limit in (('B', 0xFF), ('H', 0xFFFF), ('I', 0xFFFFFFFF), ('Q', 0xFFFFFFFFFFFFFFFF)):
+            if high <= limit:
+                return code
+    else:
+        for code, limit in (('b', 0x7F), ('h', 0x7FFF), ('i', 0x7FFFFFFF), ('q', 0x7FFFFFFFFFFFFFFF)):
+            if -limit - 1 <= low and high <= limit:
+                return code
+    return None
+
+
+def _bin_header_size(n):
+    # Size of a BIN* header or of an EXT* header without its code.
+    if n <= 0xFF:
+        return 2
+    elif n <= 0xFFFF:
+        return 3
+    return 5
+
+
+def _array_header_size(n):
+    if 0 < n <= 0x1F:
+        return 1
+    return _bin_header_size(n)
+
+
+def _str_header_size(n):
+    if n <= 0x3F:
+        return 1
+    return _bin_header_size(n)
+
+
+def _packed_int_size(obj):
+    if -0x20 <= obj <= 0x1F:
+        return 1
+    elif -0x80 <= obj <= 0xFF:
+        return 2
+    elif -0x8000 <= obj <= 0xFFFF:
+        return 3
+    elif -0x80000000 <= obj <= 0xFFFFFFFF:
+        return 5
+    return 9
+
+
+def _encode_delta(obj):
+    # Encodes a list of integers as the first value, the smallest difference
+    # between neighbors and then every difference minus the smallest one
+    # with the narrowest width that fits. Returns None if it doesn't fit.
+    if len(obj) < _DELTA_MIN_LEN or not all(type(x) is int for x in obj):
+        return None
+    # Only integers that can be packed on their own are delta encoded.
+    if min(obj) < -0x8000000000000000 or max(obj) > 0xFFFFFFFFFFFFFFFF:
+        return None
+    base = obj[0]
+    deltas = list(map(operator.sub, itertools.islice(obj, 1, None), obj))
+    low = min(deltas)
+    if not (-0x8000000000000000 <= base <= 0x7FFFFFFFFFFFFFFF and
+            -0x8000000000000000 <= low <= 0x7FFFFFFFFFFFFFFF):
+        return None
+    spread = max(deltas) - low
+    for width, code in _DELTA_WIDTHS:
+        if spread <= width:
+            break
+    else:
+        return None
+    data = _STRUCT_DELTA.pack(len(obj), base, low, struct.calcsize(code))
+    if code:
+        data += struct.pack(f'>{len(deltas)}{code}', *(map(operator.sub, deltas, itertools.repeat(low))))
+    return data
+
+
+def _pack_bits(bits):
+    # Packs a bytes object of zeros and ones into a bitmap
+    # with the first value in the least significant bit.
+    if not bits:
+        return b''
+    return int(bits[::-1].translate(_BITS_TO_ASCII), 2).to_bytes((len(bits) + 7) // 8, 'little')
+
+
+def _unpack_bits(data, n):
+    return list(itertools.islice(itertools.chain.from_iterable(map(_BYTE_TO_BITS.__getitem__, data)), n))
+
+
+def _is_ndarray(obj):
+    # numpy is slow to import so it's never imported to check for
+    # arrays which only exist once something else has imported it.
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(obj, numpy.ndarray)
+
+
+def _float32_exact_array(obj):
+    # Checks that every float round-trips through single precision at once.
+    if _is_ndarray(obj):
+        import numpy
+        return bool(numpy.array_equal(obj.astype(numpy.float32), obj))
+    return array.array('f', obj).tolist() == obj
+
+
+def _is_dataclass(cls):
+    # The dataclasses module is only imported once a dataclass is
+    # seen as it doesn't exist before Python 3.7.
+    return getattr(cls, '__dataclass_fields__', None) is not None
+
+
+def _class_fields(cls):
+    # Returns the names of the fields of a dataclass, namedtuple
+    # or class with __slots__ in the order they're packed.
+    if _is_dataclass(cls):
+        import dataclasses
+        return tuple(field.name for field in dataclasses.fields(cls))
+    elif issubclass(cls, tuple) and hasattr(cls, '_fields'):
+        return tuple(cls._fields)
+    names = []
+    for base in reversed(cls.__mro__):
+        slots = base.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names.extend(name for name in slots if name not in ('__dict__', '__weakref__'))
+    if not names:
+        raise TypeError(f'{cls.__name__} is not a dataclass, namedtuple or class with __slots__')
+    return tuple(names)
+
+
+def _class_builder(cls, names):
+    # Returns a function that creates an instance from its field values.
+    if issubclass(cls, tuple):
+        return cls._make
+    elif _is_dataclass(cls):
+        import dataclasses
+        if all(field.init for field in dataclasses.fields(cls)):
+            return lambda values: cls(*values)
+
+    def build(values):
+        obj = cls.__new__(cls)
+        for name, value in zip(names, values):
+            object.__setattr__(obj, name, value)
+        return obj
+    return build
 
 
 def _get_data_from_buffer(obj):
@@ -89,18 +308,64 @@ def _get_data_from_buffer(obj):
     return view
 
 
+class _Pool(threading.local):
+    # Packers and unpackers that packb() and unpackb() reuse for each set
+    # of options. Every thread has its own and instances are taken out
+    # while they're used so calls from within hooks create new ones.
+    def __init__(self):
+        self.instances = {}
+
+
+_pool = _Pool()
+
+
+def _pool_acquire(cls, kwargs):
+    if not kwargs:
+        return cls, _pool.instances.pop(cls, None)
+
+    # Instances are only reused for hashable options that don't keep
+    # state from one call to the next. Registries are copied when an
+    # instance is created and would be stale after registering more.
+    if (kwargs.get('autoreset', True) is not True or isinstance(kwargs.get('schema'), str) or
+            kwargs.get('ext_registry') is not None):
+        return None, None
+    try:
+        key = (cls, frozenset(kwargs.items()))
+        return key, _pool.instances.pop(key, None)
+    except TypeError:
+        return None, None
+
+
+def _pool_release(key, obj):
+    instances = _pool.instances
+    instances[key] = obj
+    if len(instances) > _POOL_SIZE:
+        del instances[next(iter(instances))]
+
+
 def unpack(stream, **kwargs):
     data = stream.read()
     return unpackb(data, **kwargs)
 
 
 def unpackb(data, **kwargs):
-    unpacker = Unpacker(None, **kwargs)
-    unpacker.feed(data)
-    ret = unpacker._unpack(_CMD_CONSTRUCT)
-    if unpacker._got_extra_data():
-        raise ExtraData(ret, unpacker._get_extra_data())
-    return ret
+    """Unpacks a single object from ``data``. Unlike ``Unpacker`` this is
+    safe to call from multiple threads at once, each thread reuses its own
+    ``Unpacker`` for options that are all hashable.
+    """
+    key, unpacker = _pool_acquire(Unpacker, kwargs)
+    if unpacker is None:
+        unpacker = Unpacker(None, **kwargs)
+    try:
+        unpacker.feed(data)
+        ret = unpacker._unpack(_CMD_CONSTRUCT)
+        if unpacker._got_extra_data():
+            raise ExtraData(ret, unpacker._get_extra_data())
+        return ret
+    finally:
+        if key is not None:
+            unpacker._reset()
+            _pool_release(key, unpacker)
 
 
 class Unpacker(object):
@@ -110,6 +375,14 @@ class Unpacker(object):
                  object_pairs_hook=None,
                  list_hook=None,
                  ext_hook=ExtType,
+                 lazy_str=False,
+                 raw_fields=None,
+                 shared_refs=False,
+                 columnar='rows',
+                 classes=(),
+                 schema=None,
+                 ext_registry=None,
+                 stats=None,
                  max_buffer_size=_DEFAULT_MAX_LEN,
                  max_str_len=_DEFAULT_MAX_LEN,
                  max_bin_len=_DEFAULT_MAX_LEN,
@@ -120,12 +393,27 @@ class Unpacker(object):
         if file_like is None:
             self._feeding = True
         else:
-            if not callable(file_like.read):
+            # Files are read straight into our buffer when they support
+            # readinto() and sockets with recv_into(). readinto1() and
+            # recv_into() don't wait for more data than is available
+            # so they're given all of the free space in the buffer.
+            self._read_into = None
+            self._read_ahead = False
+            for name in ('readinto1', 'recv_into', 'readinto'):
+                read_into = getattr(file_like, name, None)
+                if callable(read_into):
+                    self._read_into = read_into
+                    self._read_ahead = name != 'readinto'
+                    break
+            if self._read_into is None and not callable(file_like.read):
                 raise TypeError('file.read must be callable')
             self.file_like = file_like
             self._feeding = False
 
+        # The buffer is reused between reads and only holds data up to
+        # _buffer_end, the bytes after it are free space to read into.
         self._buffer = bytearray()
+        self._buffer_end = 0
         self._buffer_i = 0
         self._max_buffer_size = max_buffer_size
         self._stream_offset = 0
@@ -138,6 +426,59 @@ class Unpacker(object):
         self._object_pairs_hook = object_pairs_hook
         self._list_hook = list_hook
         self._ext_hook = ext_hook
+        self._lazy_str = lazy_str
+        self._raw_fields = None if raw_fields is None else frozenset(raw_fields)
+
+        # Objects that references have been resolved to since the last checkpoint.
+        self._shared_refs = shared_refs
+        self._ref_objects = {}
+
+        # References are counted from the start of the outermost object
+        # which isn't complete yet. Objects read one at a time after
+        # read_array_header() or read_map_header() are within it and the
+        # buffer from its start is kept. The number of items left in every
+        # container opened with those methods is kept, outermost first.
+        self._ref_base = 0
+        self._open_counts = []
+        self._resolving_refs = set()
+        self._skipped_ref = False
+
+        if columnar not in _COLUMNAR_LAYOUTS:
+            raise ValueError(f'columnar must be one of {_COLUMNAR_LAYOUTS!r}')
+        if columnar == 'ndarray':
+            try:
+                import numpy  # noqa: F401
+            except ImportError:
+                raise ValueError("columnar='ndarray' requires numpy") from None
+        self._columnar = columnar
+
+        # Encoded keys with the size of their headers, field names, a builder
+        # and the order to pass the values to the builder in for every
+        # class by number of fields. Keys may be in declared or sorted order.
+        self._class_decoders = {}
+        for cls in classes:
+            names = _class_fields(cls)
+            self._add_class_decoder(names, _class_builder(cls, names))
+
+        # Maps with the keys of the schema are unpacked as tuples or
+        # instances of a class. An inferred schema is set by the first map.
+        self._schema = None
+        self._infer_schema = False
+        if schema == 'infer':
+            self._infer_schema = True
+        elif isinstance(schema, str):
+            raise ValueError("schema must be 'infer', a sequence of field names or a class")
+        elif isinstance(schema, type):
+            self._schema = _class_fields(schema)
+            self._add_class_decoder(self._schema, _class_builder(schema, self._schema))
+        elif schema is not None:
+            self._schema = tuple(schema)
+            if not all(isinstance(name, str) for name in self._schema):
+                raise TypeError('schema field names must be str')
+            self._add_class_decoder(self._schema, tuple)
+
+        # Decoders by extension code are copied from the registry once.
+        self._ext_decoders = {} if ext_registry is None else dict(ext_registry._decoders)
 
         self._max_str_len = max_str_len
         self._max_bin_len = max_bin_len
@@ -145,6 +486,14 @@ class Unpacker(object):
         self._max_map_len = max_map_len
         self._max_ext_len = max_ext_len
 
+        # Hooks and reading are only wrapped when stats are recorded.
+        if stats is not None:
+            stats._instrument_unpacker(self)
+
+    @property
+    def schema(self):
+        return self._schema
+
     def skip(self):
         self._unpack(_CMD_SKIP)
         self._consume()
@@ -154,14 +503,19 @@ class Unpacker(object):
         self._consume()
         return ret
 
+    def unpack_raw(self):
+        ret = self._unpack_raw()
+        self._consume()
+        return ret
+
     def read_array_header(self):
         ret = self._unpack(_CMD_READ_ARRAY_HEADER)
-        self._consume()
+        self._consume_header(ret)
         return ret
 
     def read_map_header(self):
         ret = self._unpack(_CMD_READ_MAP_HEADER)
-        self._consume()
+        self._consume_header(2 * ret)
         return ret
 
     def tell(self):
@@ -170,22 +524,55 @@ class Unpacker(object):
     def feed(self, data):
         assert self._feeding
         view = _get_data_from_buffer(data)
-        if len(self._buffer) - self._buffer_i + len(view) > self._max_buffer_size:
+        end = self._buffer_end
+        if end - self._buffer_i + len(view) > self._max_buffer_size:
             raise BufferFull()
-        self._buffer += view
+        if end + len(view) > len(self._buffer) and self._buffer_used_i > 0:
+            self._compact()
+            end = self._buffer_end
+        self._buffer[end:end + len(view)] = view
+        self._buffer_end = end + len(view)
 
     def read_bytes(self, n):
         return self._read(n)
 
+    def _reset(self):
+        # Reused unpackers don't hold onto large buffers.
+        if len(self._buffer) > _POOL_MAX_BUFFER_SIZE:
+            self._buffer = bytearray()
+        self._buffer_end = self._buffer_i = self._buffer_used_i = 0
+        self._stream_offset = 0
+        self._ref_base = 0
+        self._open_counts.clear()
+        self._ref_objects.clear()
+
     def _consume(self):
         self._stream_offset += self._buffer_i - self._buffer_used_i
         self._buffer_used_i = self._buffer_i
+        open_counts = self._open_counts
+        while open_counts:
+            open_counts[-1] -= 1
+            if open_counts[-1]:
+                return
+            open_counts.pop()
+        self._ref_base = self._stream_offset
+        if self._ref_objects:
+            self._ref_objects.clear()
+
+    def _consume_header(self, n):
+        if not n:
+            return self._consume()
+        if not self._open_counts:
+            self._ref_base = self._stream_offset
+        self._stream_offset += self._buffer_i - self._buffer_used_i
+        self._buffer_used_i = self._buffer_i
+        self._open_counts.append(n)
 
     def _got_extra_data(self):
-        return self._buffer_i < len(self._buffer)
+        return self._buffer_i < self._buffer_end
 
     def _get_extra_data(self):
-        return self._buffer[self._buffer_i:]
+        return self._buffer[self._buffer_i:self._buffer_end]
 
     def _read(self, n):
         self._reserve(n)
@@ -194,7 +581,7 @@ class Unpacker(object):
         return self._buffer[i:self._buffer_i]
 
     def _reserve(self, n):
-        remain_bytes = len(self._buffer) - self._buffer_i - n
+        remain_bytes = self._buffer_end - self._buffer_i - n
 
         # Buffer has n bytes already.
         if remain_bytes >= 0:
@@ -204,26 +591,56 @@ class Unpacker(object):
             self._buffer_i = self._buffer_used_i
             raise OutOfData()
 
-        # Strip buffer before checkpoint before reading file
-        if self._buffer_used_i > 0:
-            del self._buffer[:self._buffer_used_i]
-            self._buffer_i -= self._buffer_used_i
-            self._buffer_used_i = 0
-
         remain_bytes = -remain_bytes
         while remain_bytes > 0:
-            to_read_bytes = max(self._read_size, remain_bytes)
-            read_data = self.file_like.read(to_read_bytes)
-            if not read_data:
+            read_bytes = self._read_file(max(self._read_size, remain_bytes))
+            if not read_bytes:
                 break
-            assert isinstance(read_data, bytes)
-            self._buffer += read_data
-            remain_bytes -= len(read_data)
+            remain_bytes -= read_bytes
 
-        if len(self._buffer) < n + self._buffer_i:
-            self._buffer_i = 0  # Rollback
+        if self._buffer_end < n + self._buffer_i:
+            self._buffer_i = self._buffer_used_i  # Rollback
             raise OutOfData()
 
+    def _read_file(self, n):
+        end = self._buffer_end
+        if end + n > len(self._buffer):
+            # Strip buffer before checkpoint before growing it, the
+            # buffer at least doubles so that it's rarely reallocated.
+            self._compact()
+            end = self._buffer_end
+            if end + n > len(self._buffer):
+                size = max(2 * len(self._buffer), end + n, _MIN_READ_BUFFER_SIZE)
+                self._buffer += bytes(size - len(self._buffer))
+
+        if self._read_into is not None:
+            if self._read_ahead:
+                n = len(self._buffer) - end
+            with memoryview(self._buffer) as view, view[end:end + n] as target:
+                read_bytes = self._read_into(target)
+            if not read_bytes:
+                return 0
+        else:
+            read_data = self.file_like.read(n)
+            if not read_data:
+                return 0
+            read_bytes = len(read_data)
+            self._buffer[end:end + read_bytes] = read_data
+
+        self._buffer_end = end + read_bytes
+        return read_bytes
+
+    def _compact(self):
+        # Only the data after the checkpoint, or after the start of the
+        # object references are counted from, is moved to the front.
+        keep = self._buffer_used_i - (self._stream_offset - self._ref_base)
+        if keep > 0:
+            end = self._buffer_end
+            self._buffer[:end - keep] = self._buffer[keep:end]
+            self._buffer_i -= keep
+            self._buffer_end = end - keep
+            self._buffer_used_i -= keep
+
     def _unpack(self, command: int=_CMD_CONSTRUCT, data_type: typing.Optional[int]=None):
         obj_type, n, obj, obj_dt = self._read_header(data_type)
 
@@ -239,15 +656,26 @@ class Unpacker(object):
 
         # Unpacking ARRAY
         if obj_type == _TYPE_ARRAY:
+            # Elements with a fixed width are read all at once
+            code = _TYPED_ARRAY_CODES.get(obj_dt)
+            if code is not None:
+                data = self._read(n * struct.calcsize(code))
+                if command == _CMD_SKIP:
+                    return
+                ret = list(struct.unpack(f'>{n}{code}', data))
+                if self._list_hook is not None and command != _CMD_CONSTRUCT_LIST:
+                    ret = self._list_hook(ret)
+                return ret
+
             # Skip over every element in the ARRAY
             if command == _CMD_SKIP:
                 for _ in range(n):
-                    self._unpack(_CMD_SKIP)
+                    self._unpack(_CMD_SKIP, data_type=obj_dt)
                 return
             ret = newlist_hint(n)
             for _ in range(n):
                 ret.append(self._unpack(_CMD_CONSTRUCT, data_type=obj_dt))
-            if self._list_hook is not None:
+            if self._list_hook is not None and command != _CMD_CONSTRUCT_LIST:
                 ret = self._list_hook(ret)
             return ret
 
@@ -260,7 +688,7 @@ class Unpacker(object):
             ret = newlist_hint(n)
             for _ in range(n):
                 ret.append(self._unpack(_CMD_CONSTRUCT))
-            if self._list_hook is not None:
+            if self._list_hook is not None and command != _CMD_CONSTRUCT_LIST:
                 ret = self._list_hook(ret)
             return ret
 
@@ -271,25 +699,36 @@ class Unpacker(object):
                     self._unpack(_CMD_SKIP)
                     self._unpack(_CMD_SKIP)
                 return
+            if self._infer_schema and n:
+                return self._unpack_inferred_schema(n)
+            if n in self._class_decoders:
+                ret = self._unpack_class(n)
+                if ret is not _NO_CLASS:
+                    return ret
             if self._object_pairs_hook is not None:
-                ret = self._object_pairs_hook(
-                    (self._unpack(_CMD_CONSTRUCT), self._unpack(_CMD_CONSTRUCT))
-                    for _ in range(n)
-                )
+                ret = self._object_pairs_hook(self._unpack_pair() for _ in range(n))
             else:
                 ret = {}
+                raw_fields = self._raw_fields
                 for _ in range(n):
-                    key = self._unpack(_CMD_CONSTRUCT)
-                    ret[key] = self._unpack(_CMD_CONSTRUCT)
+                    key = self._unpack(_CMD_CONSTRUCT_KEY)
+                    if raw_fields is not None and key in raw_fields:
+                        ret[key] = self._unpack_raw()
+                    else:
+                        ret[key] = self._unpack(_CMD_CONSTRUCT)
                 if self._object_hook is not None:
                     ret = self._object_hook(ret)
             return ret
 
         if command == _CMD_SKIP:
+            if obj_type == _TYPE_EXT and n == _EXT_REF:
+                self._skipped_ref = True
             return
 
-        # Unpacking STR
+        # Unpacking STR, keys are always decoded as they're hashed right away.
         if obj_type == _TYPE_STR:
+            if self._lazy_str and command == _CMD_CONSTRUCT:
+                return LazyStr(bytes(obj))
             return obj.decode('utf-8')
 
         # Unpacking BIN
@@ -298,12 +737,296 @@ class Unpacker(object):
 
         # Unpacking EXT
         elif obj_type == _TYPE_EXT:
-            return self._ext_hook(n, bytes(obj))
+            return self._unpack_ext(n, obj, command)
 
         # Unpacking INT
         assert obj_type == _TYPE_IMMEDIATE
         return obj
 
+    def _unpack_ext(self, code, data, command=_CMD_CONSTRUCT):
+        decode = self._ext_decoders.get(code)
+        if decode is not None:
+            return decode(memoryview(data))
+        if code == _EXT_REF:
+            return self._unpack_ref(data)
+        elif code == _EXT_COLUMNAR:
+            return self._unpack_columnar(data)
+        elif code == _EXT_DELTA:
+            ret = self._unpack_delta(data)
+        elif code == _EXT_BITMAP:
+            ret = self._unpack_bitmap(data)
+        elif code == _EXT_NULLABLE:
+            ret = self._unpack_nullable(data)
+        elif code == _EXT_DICTIONARY:
+            ret = self._unpack_dictionary(data)
+        else:
+            return self._ext_hook(code, bytes(data))
+        if self._list_hook is not None and command != _CMD_CONSTRUCT_LIST:
+            ret = self._list_hook(ret)
+        return ret
+
+    def _unpack_ref(self, data):
+        # References point at an earlier object by its offset from the
+        # start of the top-level object. An object that's being resolved
+        # already contains this reference, such as a container that's
+        # still open, so it's never resolved again.
+        offset = int.from_bytes(data, 'big')
+        if self._shared_refs and offset in self._ref_objects:
+            return self._ref_objects[offset]
+
+        # Offsets are relative to the last checkpoint as invalid data
+        # may read past the reference and strip the buffer before it.
+        end = self._buffer_i - self._buffer_used_i
+        i = self._buffer_used_i - (self._stream_offset - self._ref_base) + offset
+        if not 0 <= i < self._buffer_i - len(data) - 5 or offset in self._resolving_refs:
+            raise ValueError(f'invalid reference to offset {offset}')
+        self._resolving_refs.add(offset)
+        self._buffer_i = i
+        try:
+            obj = self._unpack(_CMD_CONSTRUCT)
+            if self._buffer_i - self._buffer_used_i > end - len(data) - 3:
+                raise ValueError(f'invalid reference to offset {offset}')
+        finally:
+            self._buffer_i = self._buffer_used_i + end
+            self._resolving_refs.discard(offset)
+        if self._shared_refs:
+            self._ref_objects[offset] = obj
+        return obj
+
+    def _unpack_columnar(self, data):
+        # The columns are unpacked in place from the buffer. Offsets are
+        # relative to the last checkpoint as invalid data may read past
+        # the end of the extension and strip the buffer before it.
+        end = self._buffer_i - self._buffer_used_i
+        self._buffer_i -= len(data)
+        n = self._unpack(_CMD_CONSTRUCT)
+        if type(n) is not int or n < 0:
+            raise ValueError('invalid columnar data')
+        keys = [self._unpack(_CMD_CONSTRUCT_KEY) for _ in range(self._unpack(_CMD_READ_ARRAY_HEADER))]
+        try:
+            if len(set(keys)) != len(keys):
+                raise ValueError('invalid columnar data')
+        except TypeError:
+            raise ValueError('invalid columnar data') from None
+        columns = []
+        for _ in keys:
+            column = self._unpack(_CMD_CONSTRUCT_LIST)
+            if isinstance(column, bytes):
+                column = self._unpack_typed_column(column, n)
+            if len(column) != n:
+                raise ValueError('column length does not match number of rows')
+            columns.append(column)
+        if self._buffer_i - self._buffer_used_i != end:
+            raise ValueError('invalid columnar data')
+
+        if self._columnar != 'rows':
+            if self._columnar == 'lists' and self._list_hook is not None:
+                columns = map(self._list_hook, columns)
+            return dict(zip(keys, columns))
+        build = self._row_builder(keys)
+        ret = list(map(build, zip(*columns) if keys else itertools.repeat((), n)))
+        if self._list_hook is not None:
+            ret = self._list_hook(ret)
+        return ret
+
+    def _row_builder(self, keys):
+        # Returns a function that creates a row from its values the
+        # same way as a map with these keys is unpacked.
+        if self._infer_schema and keys:
+            if not all(isinstance(key, str) for key in keys):
+                raise ValueError('schema can only be inferred from a map with str keys')
+            self._infer_schema = False
+            self._schema = tuple(keys)
+            self._add_class_decoder(self._schema, tuple)
+        for _, names, build, order in self._class_decoders.get(len(keys), ()):
+            if list(names) == keys:
+                if order is None:
+                    return build
+                return lambda values: build([values[i] for i in order])
+
+        if self._object_pairs_hook is not None:
+            object_pairs_hook = self._object_pairs_hook
+            return lambda values: object_pairs_hook(zip(keys, values))
+        elif self._object_hook is not None:
+            object_hook = self._object_hook
+            return lambda values: object_hook(dict(zip(keys, values)))
+        return lambda values: dict(zip(keys, values))
+
+    def _unpack_delta(self, data):
+        if len(data) < _STRUCT_DELTA.size:
+            raise ValueError('invalid delta data')
+        n, base, low, width = _STRUCT_DELTA.unpack_from(data)
+        code = _DELTA_CODES.get(width)
+        if not n or code is None or len(data) != _STRUCT_DELTA.size + (n - 1) * width:
+            raise ValueError('invalid delta data')
+        if width == 0:
+            deltas = itertools.repeat(low, n - 1)
+        else:
+            deltas = struct.unpack_from(f'>{n - 1}{code}', data, _STRUCT_DELTA.size)
+            if low:
+                deltas = map(low.__add__, deltas)
+        return list(itertools.accumulate(itertools.chain((base,), deltas)))
+
+    def _unpack_bitmap(self, data):
+        if len(data) < 4:
+            raise ValueError('invalid bitmap data')
+        n, = _STRUCT_UINT32.unpack_from(data)
+        if len(data) != 4 + (n + 7) // 8:
+            raise ValueError('invalid bitmap data')
+        return _unpack_bits(memoryview(data)[4:], n)
+
+    def _unpack_nullable(self, data):
+        if len(data) < _STRUCT_NULLABLE.size:
+            raise ValueError('invalid nullable data')
+        n, code = _STRUCT_NULLABLE.unpack_from(data)
+        if code[0] not in _NULLABLE_CODES:
+            raise ValueError('invalid nullable data')
+        code = code.decode('ascii')
+        bitmap_end = _STRUCT_NULLABLE.size + (n + 7) // 8
+        valid = _unpack_bits(memoryview(data)[_STRUCT_NULLABLE.size:bitmap_end], n)
+        if len(data) != bitmap_end + sum(valid) * struct.calcsize(code):
+            raise ValueError('invalid nullable data')
+        values = iter(struct.unpack_from(f'>{sum(valid)}{code}', data, bitmap_end))
+        return [next(values) if x else None for x in valid]
+
+    def _unpack_dictionary(self, data):
+        # Every distinct string is unpacked once in place from
+        # the buffer and is shared by all elements equal to it.
+        end = self._buffer_i - self._buffer_used_i
+        self._buffer_i -= len(data)
+        values = self._unpack(_CMD_CONSTRUCT_LIST)
+        indexes = self._unpack(_CMD_CONSTRUCT)
+        if (self._buffer_i - self._buffer_used_i != end or not isinstance(values, list) or
+                not isinstance(indexes, bytes) or not indexes or indexes[0] not in _DICTIONARY_CODES or
+                not all(isinstance(value, (str, LazyStr)) for value in values)):
+            raise ValueError('invalid dictionary data')
+        code = chr(indexes[0])
+        n, remainder = divmod(len(indexes) - 1, struct.calcsize(code))
+        if remainder:
+            raise ValueError('invalid dictionary data')
+        indexes = struct.unpack_from(f'>{n}{code}', indexes, 1)
+        if indexes and max(indexes) >= len(values):
+            raise ValueError('invalid dictionary data')
+        return list(map(values.__getitem__, indexes))
+
+    def _unpack_typed_column(self, data, n):
+        if not data or data[0] not in _TYPED_COLUMN_CODES:
+            raise ValueError('invalid columnar data')
+        code = chr(data[0])
+        if len(data) != 1 + n * struct.calcsize(code):
+            raise ValueError('invalid columnar data')
+        if self._columnar == 'ndarray':
+            import numpy
+            return numpy.frombuffer(data, dtype='>' + code, count=n, offset=1)
+        elif self._columnar == 'arrays':
+            ret = array.array(code)
+            ret.frombytes(memoryview(data)[1:])
+            if sys.byteorder == 'little':
+                ret.byteswap()
+            return ret
+        return list(struct.unpack_from(f'>{n}{code}', data, 1))
+
+    def _unpack_inferred_schema(self, n):
+        # Maps within the first map don't set the schema.
+        self._infer_schema = False
+        try:
+            pairs = [self._unpack_pair() for _ in range(n)]
+        except OutOfData:
+            self._infer_schema = True
+            raise
+        names = tuple(key for key, _ in pairs)
+        if not all(isinstance(name, str) for name in names):
+            raise ValueError('schema can only be inferred from a map with str keys')
+        self._schema = names
+        self._add_class_decoder(names, tuple)
+        return tuple(value for _, value in pairs)
+
+    def _add_class_decoder(self, names, build):
+        if not names:
+            return
+        key_packer = Packer()
+        keys = [key_packer.pack(name) for name in names]
+        keys = [(key, len(key) - len(name.encode('utf-8'))) for key, name in zip(keys, names)]
+        decoders = self._class_decoders.setdefault(len(names), [])
+        decoders.append((keys, names, build, None))
+        if sorted(keys) != keys:
+            order = sorted(range(len(names)), key=keys.__getitem__)
+            decoders.append(([keys[i] for i in order], [names[i] for i in order], build,
+                             [order.index(i) for i in range(len(names))]))
+
+    def _unpack_class(self, n):
+        # Keys are compared as bytes and never decoded. The map is unpacked
+        # as the first registered class whose keys all match, keeping every
+        # class whose keys have matched so far, and falls back to a dict
+        # once none of them match.
+        decoders = self._class_decoders[n]
+        values = []
+        buffer = self._buffer
+        for i in range(n):
+            matched = []
+            for decoder in decoders:
+                key, header_size = decoder[0][i]
+                if (buffer.startswith(key, self._buffer_i, self._buffer_end) or
+                        (self._buffer_end - self._buffer_i < len(key) and self._match_key(key, header_size))):
+                    matched.append(decoder)
+            if not matched:
+                if not i:
+                    return _NO_CLASS
+                pairs = list(zip(decoders[0][1], values))
+                pairs.extend(self._unpack_pair() for _ in range(n - i))
+                if self._object_pairs_hook is not None:
+                    return self._object_pairs_hook(pairs)
+                ret = dict(pairs)
+                if self._object_hook is not None:
+                    ret = self._object_hook(ret)
+                return ret
+            # Keys are packed with their length so any that match are equal.
+            decoders = matched
+            self._buffer_i += len(decoders[0][0][i][0])
+            values.append(self._unpack(_CMD_CONSTRUCT))
+        _, _, build, order = decoders[0]
+        if order is not None:
+            values = [values[i] for i in order]
+        return build(values)
+
+    def _match_key(self, key, header_size):
+        # Only the header byte is read before knowing that the next
+        # key is as long as this one so no more than it is read.
+        if self._buffer.startswith(key, self._buffer_i, self._buffer_end):
+            return True
+        self._reserve(1)
+        if self._buffer[self._buffer_i] != key[0]:
+            return False
+        if header_size > 1:
+            self._reserve(header_size)
+            if not self._buffer.startswith(key[:header_size], self._buffer_i, self._buffer_end):
+                return False
+        self._reserve(len(key))
+        return self._buffer.startswith(key, self._buffer_i, self._buffer_end)
+
+    def _unpack_pair(self):
+        key = self._unpack(_CMD_CONSTRUCT_KEY)
+        if self._raw_fields is not None and key in self._raw_fields:
+            return key, self._unpack_raw()
+        return key, self._unpack(_CMD_CONSTRUCT)
+
+    def _unpack_raw(self):
+        # Offsets are relative to the last checkpoint as reading
+        # from a file may strip the buffer before it.
+        start = self._buffer_i - self._buffer_used_i
+        skipped_ref, self._skipped_ref = self._skipped_ref, False
+        self._unpack(_CMD_SKIP)
+        end = self._buffer_i - self._buffer_used_i
+        if self._skipped_ref:
+            # References are counted from the start of the top-level object
+            # so the object is packed again without them to stand on its own.
+            self._buffer_i = self._buffer_used_i + start
+            data = Packer().pack(self._unpack(_CMD_CONSTRUCT))
+        else:
+            data = bytes(self._buffer[self._buffer_used_i + start:self._buffer_i])
+        self._skipped_ref = skipped_ref or self._skipped_ref
+        return Raw(data, (self._stream_offset + start, self._stream_offset + end))
+
     def _read_header(self, data_type: typing.Optional[int]=None) -> typing.Tuple[int, typing.Optional[int], typing.Any, typing.Optional[int]]:
         # Grabbing the header byte from our buffer
         if data_type is None:
@@ -601,6 +1324,120 @@ class Unpacker(object):
 
         return obj_type, n, obj, obj_dt
 
+    def query(self, fields=None, where=()):
+        """Iterates over the MAP records in the stream and yields only those
+        matching every predicate in ``where``. Predicates are tuples of
+        ``(field, op, value)`` where ``op`` is one of ``==``, ``!=``, ``<``,
+        ``<=``, ``>``, ``>=`` or ``in``. Keys are matched against their encoded
+        bytes and values of fields that aren't needed are skipped without
+        being constructed. When ``fields`` is given only those fields of
+        matching records are constructed and returned as a ``dict``.
+        """
+        tests = {}
+        for field, op, value in where:
+            if op not in _QUERY_OPERATORS:
+                raise ValueError(f'unknown query operator {op!r}')
+            raw_op = raw_value = None
+            if op in ('==', '!=') and isinstance(value, str):
+                raw_op, raw_value = _QUERY_OPERATORS[op], value.encode('utf-8')
+            elif op == 'in' and all(isinstance(x, str) for x in value):
+                raw_op, raw_value = _query_raw_in, frozenset(x.encode('utf-8') for x in value)
+            tests.setdefault(field.encode('utf-8'), []).append(
+                (_QUERY_OPERATORS[op], value, raw_op, raw_value)
+            )
+        projection = None
+        if fields is not None:
+            projection = {field.encode('utf-8'): field for field in fields}
+
+        while True:
+            try:
+                ret = self._query_record(projection, tests)
+            except OutOfData:
+                self._consume()
+                return
+            self._consume()
+            if ret is not _QUERY_NO_MATCH:
+                yield ret
+
+    def _query_record(self, projection, tests):
+        # Offsets are relative to the last checkpoint as reading
+        # from a file may strip the buffer before it.
+        record_start = self._buffer_i - self._buffer_used_i
+        n = self._unpack(_CMD_READ_MAP_HEADER)
+        pending = len(tests)
+        ret = {}
+        deferred = []
+
+        for i in range(n):
+            key_start = self._buffer_i - self._buffer_used_i
+            key_type, _, key, _ = self._read_header()
+            if key_type != _TYPE_STR:
+                self._buffer_i = self._buffer_used_i + key_start
+                self._unpack(_CMD_SKIP)
+                self._unpack(_CMD_SKIP)
+                continue
+            key = bytes(key)
+
+            field_tests = tests.get(key)
+            if field_tests is not None:
+                pending -= 1
+                want_value = projection is not None and key in projection
+                matched, value = self._query_test(field_tests, want_value)
+                if not matched:
+                    for _ in range((n - i - 1) * 2):
+                        self._unpack(_CMD_SKIP)
+                    return _QUERY_NO_MATCH
+                if want_value:
+                    ret[projection[key]] = value
+
+            elif projection is not None and key in projection:
+                # Values are only constructed once every predicate has passed.
+                if pending:
+                    deferred.append((projection[key], self._buffer_i - self._buffer_used_i))
+                    self._unpack(_CMD_SKIP)
+                else:
+                    ret[projection[key]] = self._unpack(_CMD_CONSTRUCT)
+            else:
+                self._unpack(_CMD_SKIP)
+
+        # A predicate on a field that isn't present never matches.
+        if pending:
+            return _QUERY_NO_MATCH
+
+        record_end = self._buffer_i - self._buffer_used_i
+        if projection is None:
+            self._buffer_i = self._buffer_used_i + record_start
+            ret = self._unpack(_CMD_CONSTRUCT)
+        else:
+            for field, offset in deferred:
+                self._buffer_i = self._buffer_used_i + offset
+                ret[field] = self._unpack(_CMD_CONSTRUCT)
+        self._buffer_i = self._buffer_used_i + record_end
+        return ret
+
+    def _query_test(self, field_tests, want_value):
+        value_start = self._buffer_i - self._buffer_used_i
+        obj_type, _, obj, _ = self._read_header()
+
+        # Compare STR values against the encoded predicate without decoding.
+        if obj_type == _TYPE_STR and all(raw_op is not None for _, _, raw_op, _ in field_tests):
+            for _, _, raw_op, raw_value in field_tests:
+                if not raw_op(obj, raw_value):
+                    return False, None
+            if not want_value:
+                return True, None
+            return True, LazyStr(bytes(obj)) if self._lazy_str else obj.decode('utf-8')
+
+        self._buffer_i = self._buffer_used_i + value_start
+        value = self._unpack(_CMD_CONSTRUCT)
+        for op, expected, _, _ in field_tests:
+            try:
+                if not op(value, expected):
+                    return False, None
+            except TypeError:
+                return False, None
+        return True, value
+
     def __iter__(self):
         return self
 
@@ -618,12 +1455,50 @@ class Packer(object):
     def __init__(self, *, default=None,
                  use_float32=False,
                  use_array=False,
+                 canonical=False,
+                 use_refs=False,
+                 use_columnar=False,
+                 use_delta=False,
+                 use_bitmap=False,
+                 use_dictionary=False,
+                 classes=(),
+                 ext_registry=None,
+                 stats=None,
                  autoreset=True):
         self._default = default
-        self._use_float32 = use_float32
+        if use_float32 not in (True, False, 'auto'):
+            raise ValueError("use_float32 must be True, False, or 'auto'")
+        self._use_float32 = use_float32 is True
+        self._auto_float32 = use_float32 == 'auto' or canonical
         self._use_array = use_array
+        self._canonical = canonical
+        self._use_columnar = use_columnar
+        self._use_delta = use_delta
+        self._use_bitmap = use_bitmap
+        self._use_dictionary = use_dictionary
         self._autoreset = autoreset
 
+        # Instances of these classes are packed as maps of their fields
+        # by an encoder that's created the first time one is packed.
+        self._classes = frozenset(classes)
+        for cls in self._classes:
+            _class_fields(cls)
+        self._class_encoders = {}
+
+        # Extension codes and encoders by type are copied from the registry once.
+        self._ext_encoders = {} if ext_registry is None else dict(ext_registry._encoders)
+
+        # Sorted key order for each key sequence seen while packing canonically.
+        self._canonical_key_orders = {}
+
+        # Offsets of the maps and arrays that have been packed so
+        # far by id(), these are only tracked while packing.
+        self._use_refs = use_refs
+        self._refs = None
+        self._refs_base = 0
+        if use_refs:
+            self._pack = self._pack_with_refs
+
         if default is not None:
             if not callable(default):
                 raise TypeError('default must be callable')
@@ -631,12 +1506,21 @@ class Packer(object):
 
         self._buffer = BytesIO()
 
+        # Packing is only wrapped when stats are recorded.
+        if stats is not None:
+            stats._instrument_packer(self)
+
     def pack(self, obj) -> bytes:
+        if self._use_refs:
+            self._refs = {}
+            self._refs_base = self._buffer.tell()
         try:
             self._pack(obj)
         except:
             self._buffer = BytesIO()
             raise
+        finally:
+            self._refs = None
         ret = self._buffer.getvalue()
         if self._autoreset:
             self._buffer = BytesIO()
@@ -706,10 +1590,22 @@ class Packer(object):
 
             # Packing MAP*
             elif isinstance(obj, dict):
+                if self._canonical:
+                    return self._pack_map_pairs(len(obj), self._canonical_items(obj), nest_limit-1)
                 return self._pack_map_pairs(len(obj), obj.items(), nest_limit-1)
 
             # Packing MARRAY*, TODO: ARRAY
             elif isinstance(obj, list):
+                if self._use_columnar and self._pack_columnar(obj, nest_limit):
+                    return
+                if self._use_delta and self._pack_delta(obj):
+                    return
+                if self._use_bitmap and self._pack_bitmap(obj):
+                    return
+                if self._use_dictionary and self._pack_dictionary(obj, nest_limit):
+                    return
+                if self._auto_float32 and self._pack_float32_array(obj):
+                    return
                 self._pack_array_header(len(obj))
                 item_next_limit = nest_limit-1
                 for item in obj:
@@ -788,9 +1684,14 @@ class Packer(object):
                 else:
                     raise PackValueError('string too large')
 
+            # Packing STR* without decoding and re-encoding
+            elif isinstance(obj, LazyStr):
+                self._pack_str_header(len(obj.data))
+                return self._buffer.write(obj.data)
+
             # Packing FLOAT32 and FLOAT64
             elif isinstance(obj, float):
-                if self._use_float32:
+                if self._use_float32 or (self._auto_float32 and _float32_exact(obj)):
                     return self._buffer.write(b'\xD9' + _STRUCT_FLOAT32.pack(obj))
                 return self._buffer.write(b'\xDA' + _STRUCT_FLOAT64.pack(obj))
 
@@ -808,6 +1709,32 @@ class Packer(object):
                 self._pack_bin_header(n)
                 return self._buffer.write(obj)
 
+            # Packing an already encoded object
+            elif isinstance(obj, Raw):
+                return self._buffer.write(obj.data)
+
+            # Packing ARRAY* of FLOAT32 or FLOAT64 from an ndarray
+            elif _is_ndarray(obj) and obj.ndim == 1 and obj.dtype.kind == 'f':
+                if self._use_float32 or obj.dtype == 'f4' or (self._auto_float32 and _float32_exact_array(obj)):
+                    self._pack_typed_array_header(len(obj), 0xD9)
+                    return self._buffer.write(obj.astype('>f4').tobytes())
+                self._pack_typed_array_header(len(obj), 0xDA)
+                return self._buffer.write(obj.astype('>f8').tobytes())
+
+            # Packing MAP* from the fields of a registered class
+            elif type(obj) in self._classes:
+                encoder = self._class_encoders.get(type(obj))
+                if encoder is None:
+                    encoder = self._class_encoders[type(obj)] = self._class_encoder(type(obj))
+                return encoder(obj, nest_limit-1)
+
+            # Packing EXT* with an encoder from the extension registry
+            elif type(obj) in self._ext_encoders:
+                code, encode = self._ext_encoders[type(obj)]
+                data = encode(obj)
+                self._pack_ext_header(code, len(data))
+                return self._buffer.write(data)
+
             # Packing EXT*
             elif isinstance(obj, ExtType):
                 self._pack_ext_header(obj.code, len(obj.data))
@@ -819,9 +1746,208 @@ class Packer(object):
                 continue
             raise TypeError(f'Cannot serialize {obj!r}')
 
+    def _class_encoder(self, cls):
+        # The map header and keys are encoded once and
+        # the values are read with a single attrgetter.
+        names = _class_fields(cls)
+        key_packer = Packer()
+        keys = [key_packer.pack(name) for name in names]
+        if self._canonical:
+            order = sorted(range(len(names)), key=keys.__getitem__)
+            names = [names[i] for i in order]
+            keys = [keys[i] for i in order]
+        header = key_packer.pack_map_header(len(names))
+        if len(names) == 1:
+            getter = lambda obj, name=names[0]: (getattr(obj, name),)
+        else:
+            getter = operator.attrgetter(*names)
+
+        def encode(obj, nest_limit):
+            write = self._buffer.write
+            pack = self._pack
+            write(header)
+            for key, value in zip(keys, getter(obj)):
+                write(key)
+                pack(value, nest_limit)
+        return encode
+
+    def _pack_with_refs(self, obj, nest_limit=_DEFAULT_NEST_LIMIT):
+        refs = self._refs
+        if refs is None or not isinstance(obj, (dict, list)):
+            return Packer._pack(self, obj, nest_limit)
+
+        # Packing a reference to an object that's already been packed
+        # if the reference is smaller than the object itself.
+        ref = refs.get(id(obj))
+        if ref is not None:
+            _, start, end = ref
+            if start <= 0xFF:
+                data = _STRUCT_UINT8.pack(start)
+            elif start <= 0xFFFF:
+                data = _STRUCT_UINT16.pack(start)
+            elif start <= 0xFFFFFFFF:
+                data = _STRUCT_UINT32.pack(start)
+            else:
+                data = _STRUCT_UINT64.pack(start)
+            if len(data) + 3 < end - start:
+                self._pack_ext_header(_EXT_REF, len(data))
+                return self._buffer.write(data)
+
+        start = self._buffer.tell() - self._refs_base
+        Packer._pack(self, obj, nest_limit)
+        if ref is None:
+            refs[id(obj)] = (obj, start, self._buffer.tell() - self._refs_base)
+
+    def _pack_columnar(self, obj, nest_limit):
+        # Only lists of maps with all the same keys in the same order are
+        # columnar. Canonical keys are sorted so their order doesn't matter.
+        # Keys also match in type so 1, 1.0 and True aren't one column.
+        if len(obj) < 2 or type(obj[0]) is not dict:
+            return False
+        if self._canonical:
+            keys = [key for key, _ in self._canonical_items(obj[0])]
+            key_types = set(zip(keys, map(type, keys)))
+            for row in obj:
+                if type(row) is not dict or len(row) != len(keys) or set(zip(row, map(type, row))) != key_types:
+                    return False
+        else:
+            keys = list(obj[0])
+            key_types = list(map(type, keys))
+            for row in obj:
+                if (type(row) is not dict or len(row) != len(keys) or list(row) != keys or
+                        list(map(type, row)) != key_types):
+                    return False
+
+        def pack_columns():
+            column_nest_limit = nest_limit - 1
+            self._pack(len(obj), column_nest_limit)
+            self._pack(keys, column_nest_limit)
+            for key in keys:
+                column = [row[key] for row in obj]
+                code = _typed_column_code(column)
+                if code is None:
+                    self._pack(column, column_nest_limit)
+                    continue
+                if code == 'd' and (self._use_float32 or (self._auto_float32 and _float32_exact_array(column))):
+                    code = 'f'
+                size = 1 + struct.calcsize(code) * len(column)
+                if self._use_delta and self._pack_delta(column, _bin_header_size(size) + size):
+                    continue
+                data = code.encode('ascii') + struct.pack(f'>{len(column)}{code}', *column)
+                self._pack_bin_header(len(data))
+                self._buffer.write(data)
+
+        self._pack_ext_payload(_EXT_COLUMNAR, pack_columns)
+        return True
+
+    def _pack_delta(self, obj, size=None):
+        # Packing a delta encoded array of integers when it's smaller
+        # than packing it as a MARRAY or the given size.
+        data = _encode_delta(obj)
+        if data is None:
+            return False
+        if size is None:
+            size = _array_header_size(len(obj)) + sum(map(_packed_int_size, obj))
+        if _bin_header_size(len(data)) + 1 + len(data) >= size:
+            return False
+        self._pack_ext_header(_EXT_DELTA, len(data))
+        self._buffer.write(data)
+        return True
+
+    def _pack_bitmap(self, obj):
+        # Packing arrays of booleans as a bitmap and arrays of integers
+        # or floats with nulls as a bitmap of nulls and a typed array.
+        n = len(obj)
+        if n < _BITMAP_MIN_LEN:
+            return False
+        if all(type(x) is bool for x in obj):
+            data = _STRUCT_UINT32.pack(n) + _pack_bits(bytes(obj))
+            self._pack_ext_header(_EXT_BITMAP, len(data))
+            self._buffer.write(data)
+            return True
+
+        values = [x for x in obj if x is not None]
+        if len(values) == n:
+            return False
+        code = _typed_column_code(values) if values else 'B'
+        if code is None:
+            return False
+        if code == 'd' and (self._use_float32 or (self._auto_float32 and _float32_exact_array(values))):
+            code = 'f'
+        if code in 'fd':
+            size = (5 if code == 'f' else 9) * len(values)
+        else:
+            size = sum(map(_packed_int_size, values))
+        size += _array_header_size(n) + n - len(values)
+
+        data = b''.join((
+            _STRUCT_NULLABLE.pack(n, code.encode('ascii')),
+            _pack_bits(bytes(x is not None for x in obj)),
+            struct.pack(f'>{len(values)}{code}', *values)
+        ))
+        if _bin_header_size(len(data)) + 1 + len(data) >= size:
+            return False
+        self._pack_ext_header(_EXT_NULLABLE, len(data))
+        self._buffer.write(data)
+        return True
+
+    def _pack_dictionary(self, obj, nest_limit):
+        # Packing arrays of strings as the distinct strings followed
+        # by the index of each element within them when it's smaller.
+        n = len(obj)
+        if n < _DICTIONARY_MIN_LEN or not all(type(x) is str for x in obj):
+            return False
+        index = {x: i for i, x in enumerate(dict.fromkeys(obj))}
+        if len(index) * 2 > n:
+            return False
+        code = 'B' if len(index) <= 0x100 else 'H' if len(index) <= 0x10000 else 'I'
+
+        sizes = {x: len(x.encode('utf-8')) for x in index}
+        values_size = _array_header_size(len(index)) + sum(_str_header_size(x) + x for x in sizes.values())
+        indexes_size = 1 + struct.calcsize(code) * n
+        size = values_size + _bin_header_size(indexes_size) + indexes_size
+        if _bin_header_size(size) + 1 + size >= _array_header_size(n) + sum(_str_header_size(sizes[x]) + sizes[x] for x in obj):
+            return False
+
+        def pack_dictionary():
+            self._pack(list(index), nest_limit - 1)
+            indexes = code.encode('ascii') + struct.pack(f'>{n}{code}', *map(index.__getitem__, obj))
+            self._pack_bin_header(len(indexes))
+            self._buffer.write(indexes)
+
+        self._pack_ext_payload(_EXT_DICTIONARY, pack_dictionary)
+        return True
+
+    def _pack_float32_array(self, obj):
+        # Packing an ARRAY* of FLOAT32 when every float is exactly
+        # representable in single precision.
+        if len(obj) < _FLOAT32_ARRAY_MIN_LEN or not all(type(x) is float for x in obj):
+            return False
+        data = array.array('f', obj)
+        if data.tolist() != obj:
+            return False
+        if sys.byteorder == 'little':
+            data.byteswap()
+        self._pack_typed_array_header(len(obj), 0xD9)
+        self._buffer.write(data.tobytes())
+        return True
+
+    def _pack_ext_payload(self, code, pack_payload):
+        # The payload is packed into its own buffer as its length is needed
+        # for the header. References aren't used within the payload.
+        buffer, refs = self._buffer, self._refs
+        self._buffer, self._refs = BytesIO(), None
+        try:
+            pack_payload()
+            data = self._buffer.getvalue()
+        finally:
+            self._buffer, self._refs = buffer, refs
+        self._pack_ext_header(code, len(data))
+        self._buffer.write(data)
+
     def _pack_array_header(self, n):
         # Packing MARRAYP
-        if 0 < n <= 0x1F:
+        if 0 < n <= 0x1F or (n == 0 and self._canonical):
             return self._buffer.write(_STRUCT_UINT8.pack(0x80 + n))
 
         # Packing MARRAY8
@@ -838,6 +1964,21 @@ class Packer(object):
         else:
             raise PackValueError('array too large')
 
+    def _pack_typed_array_header(self, n, data_type):
+        # Packing ARRAY8
+        if n <= 0xFF:
+            return self._buffer.write(b'\xC8' + _STRUCT_ARRAY8.pack(n, data_type))
+
+        # Packing ARRAY16
+        elif n <= 0xFFFF:
+            return self._buffer.write(b'\xC9' + _STRUCT_ARRAY16.pack(n, data_type))
+
+        # Packing ARRAY32
+        elif n <= 0xFFFFFFFF:
+            return self._buffer.write(b'\xCA' + _STRUCT_ARRAY32.pack(n, data_type))
+        else:
+            raise PackValueError('array too large')
+
     def _pack_map_header(self, n):
         # Packing MAPP
         if 0 <= n <= 0x3F:
@@ -857,6 +1998,25 @@ class Packer(object):
         else:
             raise PackValueError('map too large')
 
+    def _canonical_items(self, obj):
+        # Keys are ordered by their canonical encoding which is cached for
+        # every distinct sequence of keys that is seen. Keys like 1, 1.0
+        # and True are equal but encoded differently so their types are
+        # part of the cache key, and the order is kept as indexes so
+        # that equal keys such as 0.0 and -0.0 are never swapped.
+        items = list(obj.items())
+        keys = tuple(obj)
+        cache_key = (keys, tuple(map(type, keys)))
+        order = self._canonical_key_orders.get(cache_key)
+        if order is None:
+            key_packer = Packer(default=self._default, canonical=True)
+            encoded = [key_packer.pack(key) for key in keys]
+            order = sorted(range(len(keys)), key=encoded.__getitem__)
+            if len(self._canonical_key_orders) >= _CANONICAL_KEY_CACHE_SIZE:
+                self._canonical_key_orders.clear()
+            self._canonical_key_orders[cache_key] = order
+        return [items[i] for i in order]
+
     def _pack_map_pairs(self, n, pairs, nest_limit=_DEFAULT_NEST_LIMIT):
         pair_nest_limit = nest_limit - 1
         self._pack_map_header(n)
@@ -864,6 +2024,25 @@ class Packer(object):
             self._pack(k, pair_nest_limit)
             self._pack(v, pair_nest_limit)
 
+    def _pack_str_header(self, n):
+        # Packing STRP
+        if n <= 0x3F:
+            return self._buffer.write(_STRUCT_UINT8.pack(0x40 + n))
+
+        # Packing STR8
+        elif n <= 0xFF:
+            return self._buffer.write(b'\xC5' + _STRUCT_UINT8.pack(n))
+
+        # Packing STR16
+        elif n <= 0xFFFF:
+            return self._buffer.write(b'\xC6' + _STRUCT_UINT16.pack(n))
+
+        # Packing STR32
+        elif n <= 0xFFFFFFFF:
+            return self._buffer.write(b'\xC7' + _STRUCT_UINT32.pack(n))
+        else:
+            raise PackValueError('string too large')
+
     def _pack_bin_header(self, n):
         if n <= 0xFF:
             return self._buffer.write(b'\xCE' + _STRUCT_UINT8.pack(n))
@@ -876,10 +2055,47 @@ class Packer(object):
 
     def _pack_ext_header(self, code, n):
         if n <= 0xFF:
-            return self._buffer.write(b'\xDB')
+            return self._buffer.write(b'\xDB' + _STRUCT_EXT8.pack(n, code))
         elif n <= 0xFFFF:
-            return self._buffer.write(b'\xDC')
+            return self._buffer.write(b'\xDC' + _STRUCT_EXT16.pack(n, code))
         elif n <= 0xFFFFFFFF:
-            return self._buffer.write(b'\xDD')
+            return self._buffer.write(b'\xDD' + _STRUCT_EXT32.pack(n, code))
         else:
             raise PackValueError('ext too large')
+
+
+class _SizeLimitExceeded(Exception):
+    pass
+
+
+class _SizeCounter(object):
+    # Stands in for the buffer of a Packer and only counts what's written.
+    __slots__ = ('size', 'limit')
+
+    def __init__(self, limit):
+        self.size = 0
+        self.limit = limit
+
+    def write(self, data):
+        self.size += data.nbytes if isinstance(data, memoryview) else len(data)
+        if self.limit is not None and self.size > self.limit:
+            raise _SizeLimitExceeded()
+
+    def tell(self):
+        return self.size
+
+
+def encoded_size(obj, *, limit=None, **kwargs) -> int:
+    """Returns the number of bytes ``Packer(**kwargs).pack(obj)`` would
+    return without keeping them. If ``limit`` is given a size greater
+    than it is returned as soon as the limit is exceeded.
+    """
+    packer = Packer(**kwargs)
+    counter = packer._buffer = _SizeCounter(limit)
+    if packer._use_refs:
+        packer._refs = {}
+    try:
+        packer._pack(obj)
+    except _SizeLimitExceeded:
+        pass
+    return counter.size
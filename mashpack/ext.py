@@ -0,0 +1,112 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import decimal
+import struct
+import uuid
+from mashpack._fallback import _EXT_DATETIME, _EXT_DECIMAL, _EXT_UUID, _STRUCT_INT64
+
+__all__ = ['ExtRegistry']
+
+_STRUCT_DATETIME_OFFSET = struct.Struct('>qi')
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+_SECOND = datetime.timedelta(seconds=1)
+_TIMEZONES = {0: datetime.timezone.utc}
+
+
+def _encode_datetime(obj):
+    offset = obj.utcoffset()
+    if offset is None:
+        return _STRUCT_INT64.pack((obj - _EPOCH) // _MICROSECOND)
+    if offset % _SECOND:
+        raise ValueError('UTC offset must be a whole number of seconds')
+    return _STRUCT_DATETIME_OFFSET.pack((obj.replace(tzinfo=None) - _EPOCH) // _MICROSECOND, offset // _SECOND)
+
+
+def _decode_datetime(data):
+    if len(data) == 8:
+        us, = _STRUCT_INT64.unpack(data)
+        return _EPOCH + datetime.timedelta(0, 0, us)
+    elif len(data) == _STRUCT_DATETIME_OFFSET.size:
+        us, offset = _STRUCT_DATETIME_OFFSET.unpack(data)
+        tz = _TIMEZONES.get(offset)
+        if tz is None:
+            tz = _TIMEZONES[offset] = datetime.timezone(datetime.timedelta(seconds=offset))
+        return (_EPOCH + datetime.timedelta(0, 0, us)).replace(tzinfo=tz)
+    raise ValueError('invalid DATETIME extension')
+
+
+def _encode_decimal(obj):
+    return str(obj).encode('ascii')
+
+
+def _decode_decimal(data):
+    return decimal.Decimal(str(data, 'ascii'))
+
+
+def _encode_uuid(obj):
+    return obj.bytes
+
+
+def _decode_uuid(data):
+    if len(data) != 16:
+        raise ValueError('invalid UUID extension')
+    return uuid.UUID(int=int.from_bytes(data, 'big'))
+
+
+class ExtRegistry(object):
+    """Maps extension codes to the functions that decode them and Python
+    types to the extension code and function that encode them. Pass it as
+    ``ext_registry=`` to a ``Packer`` or ``Unpacker`` which copy the tables
+    when they're created, so registering afterwards only affects new ones.
+
+    Encoders return a bytes-like payload and decoders receive a
+    ``memoryview`` of the payload. Like ``classes``, only instances of
+    the exact type registered are encoded, not of its subclasses.
+
+    The built-in codecs for ``datetime.datetime``, ``decimal.Decimal``
+    and ``uuid.UUID`` use reserved extension codes and are registered
+    unless ``builtins`` is false.
+    """
+    def __init__(self, *, builtins=True):
+        self._decoders = {}
+        self._encoders = {}
+        if builtins:
+            self._register(_EXT_DATETIME, datetime.datetime, _encode_datetime, _decode_datetime)
+            self._register(_EXT_DECIMAL, decimal.Decimal, _encode_decimal, _decode_decimal)
+            self._register(_EXT_UUID, uuid.UUID, _encode_uuid, _decode_uuid)
+
+    def register(self, code, cls=None, encode=None, decode=None):
+        if not isinstance(code, int):
+            raise TypeError('code must be int')
+        if not 0 <= code <= 0x7F:
+            raise ValueError('code must be 0 to 127')
+        if (cls is None) != (encode is None):
+            raise ValueError('cls and encode must be given together')
+        if cls is None and decode is None:
+            raise ValueError('one of encode or decode is required')
+        if encode is not None and not callable(encode):
+            raise TypeError('encode must be callable')
+        if decode is not None and not callable(decode):
+            raise TypeError('decode must be callable')
+        self._register(code, cls, encode, decode)
+
+    def _register(self, code, cls, encode, decode):
+        if cls is not None:
+            self._encoders[cls] = (code, encode)
+        if decode is not None:
+            self._decoders[code] = decode
@@ -0,0 +1,238 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bz2
+import collections
+import lzma
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from mashpack import Packer, Unpacker
+
+__all__ = ['BlockInfo', 'BlockWriter', 'BlockReader']
+
+_DEFAULT_BLOCK_SIZE = 1 << 20
+
+_BLOCK_MAGIC = b'MPB'
+_BLOCK_HEADER = struct.Struct('>3sBBIIII')
+_FLAG_CHECKSUM = 0x01
+
+_CODECS = {'none': 0, 'zlib': 1, 'lzma': 2, 'bz2': 3}
+
+
+class BlockInfo(collections.namedtuple('BlockInfo', ['offset', 'records', 'size'])):
+    pass
+
+
+def _compress_block(codec, level, data, records, checksum):
+    if codec == 1:
+        compressed = zlib.compress(data, -1 if level is None else level)
+    elif codec == 2:
+        compressed = lzma.compress(data) if level is None else lzma.compress(data, preset=level)
+    elif codec == 3:
+        compressed = bz2.compress(data, 9 if level is None else level)
+    else:
+        compressed = bytes(data)
+    flags = _FLAG_CHECKSUM if checksum else 0
+    crc = zlib.crc32(compressed) if checksum else 0
+    header = _BLOCK_HEADER.pack(_BLOCK_MAGIC, codec, flags, records, len(data), len(compressed), crc)
+    return header + compressed
+
+
+def _decompress_block(codec, flags, size, crc, data):
+    if flags & _FLAG_CHECKSUM and zlib.crc32(data) != crc:
+        raise ValueError('block checksum does not match')
+    if codec == 1:
+        data = zlib.decompress(data)
+    elif codec == 2:
+        data = lzma.decompress(data)
+    elif codec == 3:
+        data = bz2.decompress(data)
+    elif codec != 0:
+        raise ValueError(f'unknown block codec {codec}')
+    if len(data) != size:
+        raise ValueError('block size does not match')
+    return data
+
+
+class BlockWriter(object):
+    """Writes Mashpack-encoded records to a file in independently compressed
+    blocks of roughly ``block_size`` bytes. Blocks are compressed on an
+    executor, a thread pool by default, and written in order.
+    """
+    def __init__(self, file_like, *,
+                 codec='zlib',
+                 level=None,
+                 block_size=_DEFAULT_BLOCK_SIZE,
+                 checksum=True,
+                 executor=None,
+                 max_workers=None,
+                 **kwargs):
+        if codec not in _CODECS:
+            raise ValueError(f'codec must be one of {tuple(_CODECS)!r}')
+        if not callable(file_like.write):
+            raise TypeError('file.write must be callable')
+
+        self.file_like = file_like
+        self._codec = _CODECS[codec]
+        self._level = level
+        self._block_size = block_size
+        self._checksum = checksum
+        self._packer = Packer(**kwargs)
+
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers)
+        self._executor = executor
+        self._max_pending = 2 * (max_workers or os.cpu_count() or 1)
+        self._pending = collections.deque()
+
+        self._block = bytearray()
+        self._block_records = 0
+
+    def write(self, obj):
+        self._block += self._packer.pack(obj)
+        self._block_records += 1
+        if len(self._block) >= self._block_size:
+            self._flush_block()
+
+    def flush(self):
+        if self._block_records:
+            self._flush_block()
+        while self._pending:
+            self.file_like.write(self._pending.popleft().result())
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._own_executor:
+                self._executor.shutdown()
+
+    def _flush_block(self):
+        self._pending.append(self._executor.submit(
+            _compress_block, self._codec, self._level, bytes(self._block),
+            self._block_records, self._checksum
+        ))
+        self._block = bytearray()
+        self._block_records = 0
+
+        # Write out finished blocks in order and limit
+        # how many blocks are held in memory at once.
+        while self._pending and (self._pending[0].done() or len(self._pending) > self._max_pending):
+            self.file_like.write(self._pending.popleft().result())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+class BlockReader(object):
+    """Reads records from a file written by ``BlockWriter``. Upcoming blocks
+    are decompressed on an executor while records are unpacked from the
+    current block. ``index()`` and ``read_block()`` allow reading a single
+    block from a seekable file without reading the ones before it.
+    """
+    def __init__(self, file_like, *,
+                 executor=None,
+                 max_workers=None,
+                 **kwargs):
+        if not callable(file_like.read):
+            raise TypeError('file.read must be callable')
+
+        self.file_like = file_like
+        self._unpacker_kwargs = kwargs
+
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers)
+        self._executor = executor
+        self._max_pending = 2 * (max_workers or os.cpu_count() or 1)
+
+    def index(self):
+        """Returns a ``BlockInfo`` for every block starting
+        at the current position of the file.
+        """
+        ret = []
+        while True:
+            offset = self.file_like.tell()
+            header = self._read_header()
+            if header is None:
+                return ret
+            _, _, records, _, compressed_size, _ = header
+            self.file_like.seek(offset + _BLOCK_HEADER.size + compressed_size)
+            ret.append(BlockInfo(offset, records, _BLOCK_HEADER.size + compressed_size))
+
+    def read_block(self, offset):
+        self.file_like.seek(offset)
+        block = self._read_block()
+        if block is None:
+            raise ValueError(f'no block at offset {offset}')
+        codec, flags, records, size, _, crc, data = block
+        return list(self._unpack_block(records, _decompress_block(codec, flags, size, crc, data)))
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown()
+
+    def __iter__(self):
+        pending = collections.deque()
+        while True:
+            while len(pending) < self._max_pending:
+                block = self._read_block()
+                if block is None:
+                    break
+                codec, flags, records, size, _, crc, data = block
+                pending.append((records, self._executor.submit(_decompress_block, codec, flags, size, crc, data)))
+            if not pending:
+                return
+            records, future = pending.popleft()
+            yield from self._unpack_block(records, future.result())
+
+    def _read_header(self):
+        data = self.file_like.read(_BLOCK_HEADER.size)
+        if not data:
+            return None
+        if len(data) != _BLOCK_HEADER.size:
+            raise ValueError('truncated block header')
+        magic, codec, flags, records, size, compressed_size, crc = _BLOCK_HEADER.unpack(data)
+        if magic != _BLOCK_MAGIC:
+            raise ValueError('invalid block header')
+        return codec, flags, records, size, compressed_size, crc
+
+    def _read_block(self):
+        header = self._read_header()
+        if header is None:
+            return None
+        data = self.file_like.read(header[4])
+        if len(data) != header[4]:
+            raise ValueError('truncated block')
+        return header + (data,)
+
+    def _unpack_block(self, records, data):
+        unpacker = Unpacker(None, **self._unpacker_kwargs)
+        unpacker.feed(data)
+        for _ in range(records):
+            yield unpacker.unpack()
+        if unpacker._got_extra_data():
+            raise ValueError('block has data after its last record')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
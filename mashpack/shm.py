@@ -0,0 +1,169 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import queue
+import struct
+import threading
+from multiprocessing import shared_memory
+from mashpack import Unpacker, packb
+
+__all__ = ['RingBuffer']
+
+_DEFAULT_RING_SIZE = 1 << 20
+
+# Total bytes written and read since the ring was created.
+_RING_HEADER = struct.Struct('<QQ')
+_FRAME_HEADER = struct.Struct('<I')
+_MAX_FRAME_LEN = 0xFFFFFFFF
+
+
+def _attach(name):
+    # Only the process that created the segment unlinks it.
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name)
+
+
+class RingBuffer(object):
+    """Passes Mashpack-encoded objects between processes through a ring
+    buffer in a ``multiprocessing.shared_memory`` segment, which requires
+    Python 3.8 or later. Any number of processes and threads may ``put()``
+    and ``get()`` at once, ``put()`` waits while the ring is full and
+    ``get()`` while it's empty. Packed objects are at most 4 GiB.
+
+    A ``RingBuffer`` is passed to other processes as an argument of
+    ``multiprocessing.Process``. Every process should ``close()`` it and
+    the creating process ``unlink()`` it once it's no longer used.
+    """
+    def __init__(self, size=_DEFAULT_RING_SIZE, *,
+                 ctx=None,
+                 packer_kwargs=None,
+                 unpacker_kwargs=None):
+        if size <= 0:
+            raise ValueError('size must be positive')
+        if ctx is None:
+            ctx = multiprocessing.get_context()
+
+        # Frames start on 4 byte boundaries so that
+        # their length is never split by the end of the ring.
+        capacity = (size + 3) & ~3
+        shm = shared_memory.SharedMemory(create=True, size=_RING_HEADER.size + capacity)
+        _RING_HEADER.pack_into(shm.buf, 0, 0, 0)
+
+        lock = ctx.Lock()
+        self._state = (shm.name, capacity, ctx.Condition(lock), ctx.Condition(lock),
+                       dict(packer_kwargs or {}), dict(unpacker_kwargs or {}))
+        self._open(shm)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    def put(self, obj, block=True, timeout=None):
+        data = packb(obj, **self._packer_kwargs)
+        n = len(data)
+        if n > _MAX_FRAME_LEN:
+            raise ValueError(f'packed object of {n} bytes is too large for a frame')
+        frame_size = _FRAME_HEADER.size + ((n + 3) & ~3)
+        if frame_size > self._capacity:
+            raise ValueError(f'packed object of {n} bytes does not fit in the ring')
+
+        with self._not_full:
+            if not self._not_full.wait_for(lambda: self._free() >= frame_size, timeout if block else 0):
+                raise queue.Full()
+            written, read = _RING_HEADER.unpack_from(self._shm.buf, 0)
+            i = written % self._capacity
+            _FRAME_HEADER.pack_into(self._ring, i, n)
+            self._copy_in((i + _FRAME_HEADER.size) % self._capacity, data)
+            _RING_HEADER.pack_into(self._shm.buf, 0, written + frame_size, read)
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        unpacker = getattr(self._local, 'unpacker', None)
+        if unpacker is None:
+            unpacker = self._local.unpacker = Unpacker(None, **self._unpacker_kwargs)
+
+        # The frame is copied into the buffer of the unpacker while the
+        # ring is locked and unpacked from there once it's released.
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._used() > 0, timeout if block else 0):
+                raise queue.Empty()
+            written, read = _RING_HEADER.unpack_from(self._shm.buf, 0)
+            i = read % self._capacity
+            n, = _FRAME_HEADER.unpack_from(self._ring, i)
+            self._copy_out((i + _FRAME_HEADER.size) % self._capacity, n, unpacker)
+            _RING_HEADER.pack_into(self._shm.buf, 0, written, read + _FRAME_HEADER.size + ((n + 3) & ~3))
+            self._not_full.notify_all()
+
+        start = unpacker.tell()
+        try:
+            obj = unpacker.unpack()
+            if unpacker.tell() - start != n:
+                raise ValueError('frame has data after its object')
+        except BaseException:
+            self._local.unpacker = None
+            raise
+        return obj
+
+    def close(self):
+        if self._ring is not None:
+            self._ring.release()
+            self._ring = None
+            self._shm.close()
+
+    def unlink(self):
+        self._shm.unlink()
+
+    def _open(self, shm):
+        _, self._capacity, self._not_empty, self._not_full, self._packer_kwargs, self._unpacker_kwargs = self._state
+        self._shm = shm
+        self._ring = shm.buf[_RING_HEADER.size:_RING_HEADER.size + self._capacity]
+        self._local = threading.local()
+
+    def _used(self):
+        written, read = _RING_HEADER.unpack_from(self._shm.buf, 0)
+        return written - read
+
+    def _free(self):
+        return self._capacity - self._used()
+
+    def _copy_in(self, i, data):
+        n = min(len(data), self._capacity - i)
+        if n == len(data):
+            self._ring[i:i + n] = data
+        else:
+            view = memoryview(data)
+            self._ring[i:i + n] = view[:n]
+            self._ring[:len(data) - n] = view[n:]
+
+    def _copy_out(self, i, n, unpacker):
+        end = min(i + n, self._capacity)
+        unpacker.feed(self._ring[i:end])
+        if end - i < n:
+            unpacker.feed(self._ring[:n - (end - i)])
+
+    def __getstate__(self):
+        return self._state
+
+    def __setstate__(self, state):
+        self._state = state
+        self._open(_attach(state[0]))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
@@ -0,0 +1,193 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import struct
+from time import perf_counter
+from mashpack._fallback import (
+    Unpacker, _CMD_CONSTRUCT, _TYPE_MAP, _TYPE_ARRAY, _TYPE_MARRAY, _TYPE_EXT, _TYPED_ARRAY_CODES
+)
+
+__all__ = ['Stats']
+
+_HEADER_NAMES = (
+    ['MAPP'] * 0x40 + ['STRP'] * 0x40 + ['MARRAYP'] * 0x20 + ['INTP'] * 0x20 + [
+        'FALSE', 'TRUE', 'MAP8', 'MAP16', 'MAP32', 'STR8', 'STR16', 'STR32',
+        'ARRAY8', 'ARRAY16', 'ARRAY32', 'MARRAY8', 'MARRAY16', 'MARRAY32', 'BIN8', 'BIN16',
+        'BIN32', 'INT8', 'INT16', 'INT32', 'INT64', 'UINT8', 'UINT16', 'UINT32',
+        'UINT64', 'FLOAT32', 'FLOAT64', 'EXT8', 'EXT16', 'EXT32', 'RESERVED', 'NULL'
+    ] + ['NINTP'] * 0x20
+)
+_CONTAINER_NAMES = {_TYPE_MAP: 'MAP', _TYPE_ARRAY: 'ARRAY', _TYPE_MARRAY: 'MARRAY'}
+_HOOKS = ('object_hook', 'object_pairs_hook', 'list_hook', 'ext_hook')
+
+
+def _bucket(n):
+    # Histograms count values by the next power of two.
+    return 0 if n <= 0 else 1 << (n - 1).bit_length()
+
+
+def _new_section():
+    return {
+        'types': {},
+        'containers': {},
+        'hooks': {},
+        'latency': {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'histogram_us': {}}
+    }
+
+
+class Stats(object):
+    """Records what ``Packer`` and ``Unpacker`` objects created with
+    ``stats=`` spend time and bytes on. Counts and encoded bytes are kept
+    per header type along with container lengths, calls and time spent in
+    ``default`` and the unpacking hooks, and the time taken by every
+    top-level object. Objects created without ``stats`` aren't affected.
+
+    A ``Stats`` object may be shared by a ``Packer`` and an ``Unpacker``
+    but like them isn't safe to use from multiple threads at once.
+
+    Packed objects are counted by reading back what the ``Packer`` wrote,
+    which makes ``pack()`` several times slower, so stats are meant for
+    profiling rather than for every ``Packer``.
+    """
+    def __init__(self):
+        self._sections = {'pack': _new_section(), 'unpack': _new_section()}
+
+    def snapshot(self) -> dict:
+        return copy.deepcopy(self._sections)
+
+    def reset(self):
+        for section in self._sections.values():
+            section.clear()
+            section.update(_new_section())
+
+    def _instrument_packer(self, packer):
+        section = self._sections['pack']
+        if packer._default is not None:
+            packer._default = self._timed_hook(section, 'default', packer._default)
+
+        # Headers are counted by reading them back from the packed bytes
+        # as the packer writes headers and payloads in many places.
+        def count_objects(pack):
+            def pack_with_stats(*args):
+                offset = packer._buffer.tell()
+                start = perf_counter()
+                ret = pack(*args)
+                self._record_latency(section, perf_counter() - start)
+                unpacker = Unpacker(None)
+                self._count_headers(unpacker, section)
+                unpacker.feed(memoryview(ret)[offset:])
+                while unpacker._got_extra_data():
+                    unpacker.skip()
+                return ret
+            return pack_with_stats
+
+        # Headers packed on their own are followed by data
+        # that isn't packed yet so only the header is read.
+        def count_header(pack_header, obj_type):
+            def pack_header_with_stats(*args):
+                offset = packer._buffer.tell()
+                ret = pack_header(*args)
+                self._record_header(section, ret[offset], (obj_type, args[-1], None, None), len(ret) - offset)
+                return ret
+            return pack_header_with_stats
+
+        packer.pack = count_objects(packer.pack)
+        packer.pack_map_pairs = count_objects(packer.pack_map_pairs)
+        packer.pack_map_header = count_header(packer.pack_map_header, _TYPE_MAP)
+        packer.pack_array_header = count_header(packer.pack_array_header, _TYPE_MARRAY)
+        packer.pack_ext_header = count_header(packer.pack_ext_header, _TYPE_EXT)
+
+    def _instrument_unpacker(self, unpacker):
+        section = self._sections['unpack']
+        self._count_headers(unpacker, section)
+        for name in _HOOKS:
+            hook = getattr(unpacker, '_' + name)
+            if hook is not None:
+                setattr(unpacker, '_' + name, self._timed_hook(section, name, hook))
+
+        # Only the outermost call is timed for every object.
+        unpack = unpacker._unpack
+        depth = [0]
+
+        def unpack_with_stats(command=_CMD_CONSTRUCT, data_type=None):
+            if depth[0]:
+                return unpack(command, data_type)
+            depth[0] = 1
+            try:
+                start = perf_counter()
+                ret = unpack(command, data_type)
+                self._record_latency(section, perf_counter() - start)
+                return ret
+            finally:
+                depth[0] = 0
+
+        unpacker._unpack = unpack_with_stats
+
+    def _count_headers(self, unpacker, section):
+        read_header = unpacker._read_header
+
+        def read_header_with_stats(data_type=None):
+            # Offsets are relative to the last checkpoint as reading
+            # from a file may strip the buffer before it.
+            start = unpacker._buffer_i - unpacker._buffer_used_i
+            ret = read_header(data_type)
+            used = unpacker._buffer_used_i
+            b = unpacker._buffer[used + start] if data_type is None else data_type
+            self._record_header(section, b, ret, unpacker._buffer_i - used - start)
+            return ret
+
+        unpacker._read_header = read_header_with_stats
+
+    def _record_header(self, section, b, header, size):
+        obj_type, n, _, obj_dt = header
+        self._add_type(section, _HEADER_NAMES[b], 1, size)
+        if obj_type in _CONTAINER_NAMES:
+            histogram = section['containers'].setdefault(_CONTAINER_NAMES[obj_type], {})
+            bucket = _bucket(n)
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+
+            # Elements with a fixed width are read without their headers.
+            code = _TYPED_ARRAY_CODES.get(obj_dt) if obj_type == _TYPE_ARRAY else None
+            if code is not None:
+                self._add_type(section, _HEADER_NAMES[obj_dt], n, n * struct.calcsize(code))
+
+    def _add_type(self, section, name, count, size):
+        entry = section['types'].get(name)
+        if entry is None:
+            entry = section['types'][name] = {'count': 0, 'bytes': 0}
+        entry['count'] += count
+        entry['bytes'] += size
+
+    def _record_latency(self, section, seconds):
+        latency = section['latency']
+        latency['count'] += 1
+        latency['seconds'] += seconds
+        if seconds > latency['max_seconds']:
+            latency['max_seconds'] = seconds
+        bucket = _bucket(int(seconds * 1e6))
+        latency['histogram_us'][bucket] = latency['histogram_us'].get(bucket, 0) + 1
+
+    def _timed_hook(self, section, name, hook):
+        def hook_with_stats(*args):
+            start = perf_counter()
+            try:
+                return hook(*args)
+            finally:
+                entry = section['hooks'].get(name)
+                if entry is None:
+                    entry = section['hooks'][name] = {'calls': 0, 'seconds': 0.0}
+                entry['calls'] += 1
+                entry['seconds'] += perf_counter() - start
+        return hook_with_stats
@@ -0,0 +1,974 @@
+# Copyright 2018 Seth Michael Larson
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import json
+import re
+import shutil
+import struct
+import sys
+import tempfile
+from json.decoder import JSONDecoder, scanstring
+from json.scanner import make_scanner
+from json.encoder import encode_basestring_ascii
+from mashpack import ExtType, Packer, Unpacker
+from mashpack.exceptions import OutOfData, ExtraData
+from mashpack._fallback import (
+    _TYPE_IMMEDIATE, _TYPE_MAP, _TYPE_STR, _TYPE_ARRAY, _TYPE_MARRAY, _TYPE_EXT,
+    _TYPED_ARRAY_CODES, _EXT_REF, _STRUCT_UINT8, _STRUCT_UINT16, _STRUCT_UINT32, _STRUCT_UINT64,
+    _STRUCT_INT8, _STRUCT_INT16, _STRUCT_INT32, _STRUCT_INT64, _STRUCT_FLOAT32, _STRUCT_FLOAT64,
+    _typed_column_code
+)
+
+__all__ = [
+    'json_to_mashpack', 'json_to_mashpack_stream',
+    'mashpack_to_json', 'mashpack_to_json_stream',
+    'msgpack_to_mashpack', 'msgpack_to_mashpack_stream',
+    'mashpack_to_msgpack', 'mashpack_to_msgpack_stream'
+]
+
+_DEFAULT_CHUNK_SIZE = 1 << 16
+_DEFAULT_SPILL_SIZE = 1 << 20
+
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_JSON_NUMBER = re.compile(r'-?(?:0|[1-9]\d*)(\.\d+)?([eE][-+]?\d+)?')
+_JSON_NUMBER_CHARS = re.compile(r'[-+.eE0-9]*')
+_JSON_LITERALS = {'t': ('true', True), 'f': ('false', False), 'n': ('null', None)}
+_NO_VALUE = object()
+_FLOAT_MIN = -sys.float_info.max
+_FLOAT_MAX = sys.float_info.max
+
+
+def _reject_constant(name):
+    raise ValueError(f'{name} is not valid JSON')
+
+
+# json's scanner, in C where it's available, without NaN and Infinity.
+_scan_json = make_scanner(JSONDecoder(parse_constant=_reject_constant))
+
+_PROMOTE_MIN_LEN = 4
+_TYPED_ARRAY_DATA_TYPES = {code: dt for dt, code in _TYPED_ARRAY_CODES.items()}
+
+# msgpack integer and float header bytes to their struct
+_MSGPACK_NUMBERS = {
+    0xCA: _STRUCT_FLOAT32, 0xCB: _STRUCT_FLOAT64,
+    0xCC: _STRUCT_UINT8, 0xCD: _STRUCT_UINT16, 0xCE: _STRUCT_UINT32, 0xCF: _STRUCT_UINT64,
+    0xD0: _STRUCT_INT8, 0xD1: _STRUCT_INT16, 0xD2: _STRUCT_INT32, 0xD3: _STRUCT_INT64,
+}
+_MSGPACK_FIXEXT_SIZES = {0xD4: 1, 0xD5: 2, 0xD6: 4, 0xD7: 8, 0xD8: 16}
+_MSGPACK_FIXEXT_HEADERS = {n: b for b, n in _MSGPACK_FIXEXT_SIZES.items()}
+
+_EVENT_VALUE = 0
+_EVENT_START_MAP = 1
+_EVENT_START_ARRAY = 2
+_EVENT_END = 3
+
+
+def json_to_mashpack(data: str) -> bytes:
+    out = io.BytesIO()
+    json_to_mashpack_stream(io.StringIO(data), out)
+    return out.getvalue()
+
+
+def json_to_mashpack_stream(fp_in, fp_out, *,
+                            chunk_size=_DEFAULT_CHUNK_SIZE,
+                            spill_size=_DEFAULT_SPILL_SIZE):
+    """Transcodes JSON text read from ``fp_in`` into Mashpack written to
+    ``fp_out`` without constructing any containers. Every top-level JSON
+    value, such as every line of NDJSON, is written as one Mashpack object.
+
+    Values that end within the ``chunk_size`` characters being read are
+    parsed at once by ``json``'s scanner, about as fast as ``json.loads()``.
+    Larger containers are read one token at a time until their values fit,
+    which is several times slower, so that memory stays bounded however
+    large the input is.
+
+    Containers are buffered until they're closed so their headers can be as
+    small as possible. Once more than ``spill_size`` bytes are buffered the
+    open containers are written out with 32-bit headers which are filled in
+    when they're closed. If ``fp_out`` isn't seekable they're written to a
+    temporary file instead and copied to ``fp_out`` once the top-level value
+    is complete.
+    """
+    writer = _MashpackWriter(fp_out, spill_size)
+    try:
+        for event, value in _JSONReader(fp_in, chunk_size).events():
+            if event == _EVENT_VALUE:
+                writer.value(value)
+            elif event == _EVENT_END:
+                writer.end()
+            else:
+                writer.start(event == _EVENT_START_MAP)
+    finally:
+        writer.close()
+
+
+def mashpack_to_json(data) -> str:
+    parts = []
+    unpacker = Unpacker(None)
+    unpacker.feed(data)
+    _write_json(unpacker, parts.append, False)
+    if unpacker._got_extra_data():
+        raise ExtraData(''.join(parts), unpacker._get_extra_data())
+    return ''.join(parts)
+
+
+def mashpack_to_json_stream(fp_in, fp_out, *, read_size=_DEFAULT_CHUNK_SIZE, **kwargs):
+    """Transcodes every Mashpack object read from ``fp_in`` into a line
+    of JSON text written to ``fp_out``. Objects are written as they're
+    read so only a small part of the stream is buffered at once.
+    """
+    unpacker = Unpacker(fp_in, read_size=read_size, **kwargs)
+    while True:
+        try:
+            unpacker._reserve(1)
+        except OutOfData:
+            return
+        _write_json(unpacker, fp_out.write, True)
+        fp_out.write('\n')
+
+
+def _json_scalar(obj):
+    # Numbers are written the same way as json.dumps() without its overhead.
+    if isinstance(obj, str):
+        return encode_basestring_ascii(obj)
+    elif obj is None:
+        return 'null'
+    elif obj is True:
+        return 'true'
+    elif obj is False:
+        return 'false'
+    elif type(obj) is int or (type(obj) is float and _FLOAT_MIN <= obj <= _FLOAT_MAX):
+        return repr(obj)
+    return json.dumps(obj)
+
+
+def _json_key(obj_type, obj):
+    # Non-string keys are converted the same way as json.dumps()
+    if obj_type == _TYPE_STR:
+        return encode_basestring_ascii(obj.decode('utf-8'))
+    elif obj_type == _TYPE_IMMEDIATE:
+        if obj is None or isinstance(obj, bool):
+            return f'"{json.dumps(obj)}"'
+        return f'"{obj!r}"'
+    raise TypeError('keys must be str, int, float, bool or None')
+
+
+def _write_json(unpacker, write, checkpoint):
+    # Open containers as [index, length, is_map, data_type]
+    stack = []
+    while True:
+        data_type = None
+        is_key = False
+        if stack:
+            frame = stack[-1]
+            i, length, is_map, data_type = frame
+            if i == length:
+                stack.pop()
+                write('}' if is_map else ']')
+                if stack:
+                    continue
+                return
+            frame[0] = i + 1
+            if is_map:
+                is_key = not i & 1
+                if i:
+                    write(',' if is_key else ':')
+                else:
+                    write('{')
+            elif i:
+                write(',')
+            else:
+                write('[')
+
+        obj_type, n, obj, obj_dt = unpacker._read_header(data_type)
+        if is_key:
+            write(_json_key(obj_type, obj))
+            continue
+
+        if obj_type == _TYPE_MAP or obj_type == _TYPE_MARRAY:
+            if n:
+                stack.append([0, 2 * n if obj_type == _TYPE_MAP else n, obj_type == _TYPE_MAP, None])
+                continue
+            write('{}' if obj_type == _TYPE_MAP else '[]')
+        elif obj_type == _TYPE_ARRAY:
+            # Elements with a fixed width are read all at once
+            code = _TYPED_ARRAY_CODES.get(obj_dt)
+            if code is not None:
+                data = unpacker._read(n * struct.calcsize(code))
+                write('[' + ','.join(map(_json_scalar, struct.unpack(f'>{n}{code}', data))) + ']')
+            elif n:
+                stack.append([0, n, False, obj_dt])
+                continue
+            else:
+                write('[]')
+        elif obj_type == _TYPE_STR:
+            write(encode_basestring_ascii(obj.decode('utf-8')))
+        elif obj_type == _TYPE_EXT:
+            # References point before the checkpoint so
+            # they can't be resolved once it's moved.
+            if checkpoint and n == _EXT_REF:
+                raise ValueError('REF extensions can only be transcoded from bytes')
+            if n < 0x80:
+                raise TypeError(f'extension code {n} can not be transcoded to JSON')
+            write(json.dumps(unpacker._unpack_ext(n, obj)))
+        elif obj_type == _TYPE_IMMEDIATE:
+            write(_json_scalar(obj))
+        else:
+            raise TypeError('BIN can not be transcoded to JSON')
+
+        if not stack:
+            return
+        # Only the current value needs to be kept in the buffer.
+        if checkpoint:
+            unpacker._consume()
+
+
+def msgpack_to_mashpack(data, *, promote_arrays=False) -> bytes:
+    out = bytearray()
+    reader = _ByteReader(data)
+    while not reader.at_end():
+        _transcode_msgpack(reader, out, promote_arrays)
+    return bytes(out)
+
+
+def msgpack_to_mashpack_stream(fp_in, fp_out, *, promote_arrays=False, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """Transcodes every MessagePack object read from ``fp_in`` into Mashpack
+    written to ``fp_out`` header by header, copying strings, binary and
+    extension payloads verbatim. With ``promote_arrays`` arrays of at least
+    four integers or floats are written as typed ``ARRAY*``.
+    MessagePack extension types must be between 0 and 127.
+    """
+    out = bytearray()
+    reader = _ByteReader(fp=fp_in, chunk_size=chunk_size)
+    while not reader.at_end():
+        _transcode_msgpack(reader, out, promote_arrays, fp_out.write, chunk_size)
+        if out:
+            fp_out.write(out)
+            out.clear()
+
+
+def mashpack_to_msgpack(data) -> bytes:
+    out = bytearray()
+    reader = _ByteReader(data)
+    while not reader.at_end():
+        _transcode_mashpack(reader, out)
+    return bytes(out)
+
+
+def mashpack_to_msgpack_stream(fp_in, fp_out, *, chunk_size=_DEFAULT_CHUNK_SIZE):
+    """Transcodes every Mashpack object read from ``fp_in`` into MessagePack
+    written to ``fp_out`` header by header. Values using the reserved
+    extension codes are written as the values they unpack to except for
+    ``REF`` which can't be resolved without the whole object.
+    """
+    out = bytearray()
+    reader = _ByteReader(fp=fp_in, chunk_size=chunk_size)
+    while not reader.at_end():
+        _transcode_mashpack(reader, out, fp_out.write, chunk_size)
+        if out:
+            fp_out.write(out)
+            out.clear()
+
+
+def _sized_header(b, n):
+    # The 8, 16 and 32-bit forms of a header have consecutive header bytes.
+    if n <= 0xFF:
+        return bytes((b, n))
+    elif n <= 0xFFFF:
+        return bytes((b + 1,)) + _STRUCT_UINT16.pack(n)
+    elif n <= 0xFFFFFFFF:
+        return bytes((b + 2,)) + _STRUCT_UINT32.pack(n)
+    raise ValueError(f'length {n} is too large')
+
+
+def _mashpack_int(obj):
+    if 0 <= obj <= 0x1F:
+        return bytes((0xA0 + obj,))
+    elif -0x20 <= obj < 0:
+        return bytes((256 + obj,))
+    elif 0 <= obj <= 0xFF:
+        return b'\xD5' + _STRUCT_UINT8.pack(obj)
+    elif 0 <= obj <= 0xFFFF:
+        return b'\xD6' + _STRUCT_UINT16.pack(obj)
+    elif 0 <= obj <= 0xFFFFFFFF:
+        return b'\xD7' + _STRUCT_UINT32.pack(obj)
+    elif 0 <= obj:
+        return b'\xD8' + _STRUCT_UINT64.pack(obj)
+    elif obj >= -0x80:
+        return b'\xD1' + _STRUCT_INT8.pack(obj)
+    elif obj >= -0x8000:
+        return b'\xD2' + _STRUCT_INT16.pack(obj)
+    elif obj >= -0x80000000:
+        return b'\xD3' + _STRUCT_INT32.pack(obj)
+    return b'\xD4' + _STRUCT_INT64.pack(obj)
+
+
+def _mashpack_array_header(n):
+    if 0 < n <= 0x1F:
+        return bytes((0x80 + n,))
+    return _sized_header(0xCB, n)
+
+
+def _mashpack_number(b, obj):
+    # Encodes a value read with the msgpack header byte b.
+    if b == 0xCA:
+        return b'\xD9' + _STRUCT_FLOAT32.pack(obj)
+    elif b == 0xCB:
+        return b'\xDA' + _STRUCT_FLOAT64.pack(obj)
+    return _mashpack_int(obj)
+
+
+# Mashpack integer header bytes to their struct
+_MASHPACK_INTS = {
+    0xD1: _STRUCT_INT8, 0xD2: _STRUCT_INT16, 0xD3: _STRUCT_INT32, 0xD4: _STRUCT_INT64,
+    0xD5: _STRUCT_UINT8, 0xD6: _STRUCT_UINT16, 0xD7: _STRUCT_UINT32, 0xD8: _STRUCT_UINT64,
+}
+
+# Single byte msgpack values which are a single byte in Mashpack too
+_MSGPACK_IMMEDIATES = [None] * 256
+for _b in range(0x80):
+    _MSGPACK_IMMEDIATES[_b] = _mashpack_int(_b)
+for _b in range(0xE0, 0x100):
+    _MSGPACK_IMMEDIATES[_b] = bytes((_b,))
+_MSGPACK_IMMEDIATES[0xC0] = b'\xDF'
+_MSGPACK_IMMEDIATES[0xC2] = b'\xC0'
+_MSGPACK_IMMEDIATES[0xC3] = b'\xC1'
+
+_MASHPACK_IMMEDIATES = [None] * 256
+for _b in range(0xA0, 0xC0):
+    _MASHPACK_IMMEDIATES[_b] = bytes((_b - 0xA0,))
+for _b in range(0xE0, 0x100):
+    _MASHPACK_IMMEDIATES[_b] = bytes((_b,))
+_MASHPACK_IMMEDIATES[0xC0] = b'\xC2'
+_MASHPACK_IMMEDIATES[0xC1] = b'\xC3'
+_MASHPACK_IMMEDIATES[0xDF] = b'\xC0'
+
+
+def _transcode_msgpack(reader, out, promote_arrays, flush=None, flush_size=_DEFAULT_CHUNK_SIZE):
+    # The read position is kept in locals and synced with the reader
+    # whenever it has to read more data or transcode an array.
+    buf, i, end = reader._refill(reader._i, 0)
+
+    # Number of objects left in each open container
+    remaining = [1]
+    b = None
+    while True:
+        while not remaining[-1]:
+            remaining.pop()
+            if not remaining:
+                reader._i = i
+                return
+        remaining[-1] -= 1
+        if flush is not None and len(out) >= flush_size:
+            flush(out)
+            out.clear()
+
+        # The first byte of an array element may have been read already.
+        if b is None:
+            if i >= end:
+                buf, i, end = reader._refill(i, 1)
+            b = buf[i]
+            i += 1
+
+        immediate = _MSGPACK_IMMEDIATES[b]
+        if immediate is not None:
+            out += immediate
+
+        # fixmap, fixarray, fixstr
+        elif b <= 0x8F:
+            out.append(b & 0x0F)
+            remaining.append(2 * (b & 0x0F))
+        elif b <= 0x9F:
+            reader._i = i
+            b, n = _transcode_msgpack_array(reader, out, b & 0x0F, promote_arrays)
+            buf, i, end = reader._refill(reader._i, 0)
+            remaining.append(n)
+            continue
+        elif b <= 0xBF:
+            n = b & 0x1F
+            if i + n > end:
+                buf, i, end = reader._refill(i, n)
+            out.append(0x40 + n)
+            out += buf[i:i + n]
+            i += n
+
+        elif b in _MSGPACK_NUMBERS:
+            st = _MSGPACK_NUMBERS[b]
+            if i + st.size > end:
+                buf, i, end = reader._refill(i, st.size)
+            out += _mashpack_number(b, st.unpack_from(buf, i)[0])
+            i += st.size
+
+        elif 0xC4 <= b <= 0xDF:
+            reader._i = i
+            b, n = _transcode_msgpack_sized(reader, out, b, promote_arrays)
+            buf, i, end = reader._refill(reader._i, 0)
+            if n is not None:
+                remaining.append(n)
+                continue
+        else:
+            raise ValueError(f'invalid msgpack header byte 0x{b:02X}')
+        b = None
+
+
+def _transcode_msgpack_sized(reader, out, b, promote_arrays):
+    # Transcodes the msgpack types with a length after their header byte.
+    # Returns the same as _transcode_msgpack_array() for arrays and maps.
+
+    # str 8, str 16, str 32
+    if 0xD9 <= b <= 0xDB:
+        n = reader.unpack((_STRUCT_UINT8, _STRUCT_UINT16, _STRUCT_UINT32)[b - 0xD9])
+        out += bytes((0x40 + n,)) if n <= 0x3F else _sized_header(0xC5, n)
+        out += reader.read(n)
+
+    # bin 8, bin 16, bin 32
+    elif 0xC4 <= b <= 0xC6:
+        n = reader.unpack((_STRUCT_UINT8, _STRUCT_UINT16, _STRUCT_UINT32)[b - 0xC4])
+        out += _sized_header(0xCE, n)
+        out += reader.read(n)
+
+    # ext 8, ext 16, ext 32, fixext
+    elif 0xC7 <= b <= 0xC9 or b in _MSGPACK_FIXEXT_SIZES:
+        if b in _MSGPACK_FIXEXT_SIZES:
+            n = _MSGPACK_FIXEXT_SIZES[b]
+        else:
+            n = reader.unpack((_STRUCT_UINT8, _STRUCT_UINT16, _STRUCT_UINT32)[b - 0xC7])
+        code = reader.unpack(_STRUCT_INT8)
+        if code < 0:
+            raise ValueError(f'msgpack extension type {code} has no Mashpack extension code')
+        out += _sized_header(0xDB, n)
+        out.append(code)
+        out += reader.read(n)
+
+    # array 16, array 32
+    elif b == 0xDC or b == 0xDD:
+        n = reader.unpack(_STRUCT_UINT16 if b == 0xDC else _STRUCT_UINT32)
+        return _transcode_msgpack_array(reader, out, n, promote_arrays)
+
+    # map 16, map 32
+    elif b == 0xDE or b == 0xDF:
+        n = reader.unpack(_STRUCT_UINT16 if b == 0xDE else _STRUCT_UINT32)
+        out += bytes((n,)) if n <= 0x3F else _sized_header(0xC2, n)
+        return None, 2 * n
+    else:
+        raise ValueError(f'invalid msgpack header byte 0x{b:02X}')
+    return None, None
+
+
+def _transcode_msgpack_array(reader, out, n, promote_arrays):
+    # Returns the first byte of the next element if it's been read already
+    # and the number of elements which are left to be transcoded.
+    if not promote_arrays or n < _PROMOTE_MIN_LEN:
+        out += _mashpack_array_header(n)
+        return None, n
+
+    # Reading elements until one isn't a number
+    header_bytes = bytearray()
+    values = []
+    b = None
+    for _ in range(n):
+        b = reader.byte()
+        if 0xE0 <= b or b <= 0x7F:
+            values.append(b - 256 if b >= 0xE0 else b)
+        elif b in _MSGPACK_NUMBERS:
+            values.append(reader.unpack(_MSGPACK_NUMBERS[b]))
+        else:
+            break
+        header_bytes.append(b)
+        b = None
+
+    code = None
+    if len(values) == n:
+        if 0xCA in header_bytes or 0xCB in header_bytes:
+            if header_bytes.count(0xCA) == n:
+                code = 'f'
+            elif header_bytes.count(0xCA) + header_bytes.count(0xCB) == n:
+                code = 'd'
+        else:
+            code = _typed_column_code(values)
+    if code is not None:
+        out += _sized_header(0xC8, n)
+        out.append(_TYPED_ARRAY_DATA_TYPES[code])
+        out += struct.pack(f'>{n}{code}', *values)
+        return None, 0
+
+    out += _mashpack_array_header(n)
+    for header_byte, value in zip(header_bytes, values):
+        out += _mashpack_number(header_byte, value)
+    return b, n - len(values)
+
+
+def _msgpack_int(obj):
+    if 0 <= obj <= 0x7F or -0x20 <= obj < 0:
+        return _STRUCT_UINT8.pack(obj & 0xFF)
+    elif 0 <= obj <= 0xFF:
+        return b'\xCC' + _STRUCT_UINT8.pack(obj)
+    elif 0 <= obj <= 0xFFFF:
+        return b'\xCD' + _STRUCT_UINT16.pack(obj)
+    elif 0 <= obj <= 0xFFFFFFFF:
+        return b'\xCE' + _STRUCT_UINT32.pack(obj)
+    elif 0 <= obj:
+        return b'\xCF' + _STRUCT_UINT64.pack(obj)
+    elif obj >= -0x80:
+        return b'\xD0' + _STRUCT_INT8.pack(obj)
+    elif obj >= -0x8000:
+        return b'\xD1' + _STRUCT_INT16.pack(obj)
+    elif obj >= -0x80000000:
+        return b'\xD2' + _STRUCT_INT32.pack(obj)
+    return b'\xD3' + _STRUCT_INT64.pack(obj)
+
+
+def _msgpack_immediate(obj):
+    if obj is None:
+        return b'\xC0'
+    elif obj is True:
+        return b'\xC3'
+    elif obj is False:
+        return b'\xC2'
+    elif isinstance(obj, int):
+        return _msgpack_int(obj)
+    return b'\xCB' + _STRUCT_FLOAT64.pack(obj)
+
+
+def _msgpack_str_header(n):
+    if n <= 0x1F:
+        return bytes((0xA0 + n,))
+    return _sized_header(0xD9, n)
+
+
+def _msgpack_container_header(b, n):
+    # fixarray and fixmap followed by their 16 and 32-bit forms.
+    if n <= 0x0F:
+        return bytes((b + n,))
+    elif n <= 0xFFFF:
+        return (b'\xDC' if b == 0x90 else b'\xDE') + _STRUCT_UINT16.pack(n)
+    return (b'\xDD' if b == 0x90 else b'\xDF') + _STRUCT_UINT32.pack(n)
+
+
+def _msgpack_ext(code, data):
+    n = len(data)
+    if n in _MSGPACK_FIXEXT_HEADERS:
+        return bytes((_MSGPACK_FIXEXT_HEADERS[n], code)) + data
+    return _sized_header(0xC7, n) + bytes((code,)) + data
+
+
+def _msgpack_encode(obj, out):
+    # Encodes the values that reserved extension codes unpack to.
+    if isinstance(obj, str):
+        data = obj.encode('utf-8')
+        out += _msgpack_str_header(len(data))
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        out += _sized_header(0xC4, len(obj))
+        out += obj
+    elif isinstance(obj, list):
+        out += _msgpack_container_header(0x90, len(obj))
+        for item in obj:
+            _msgpack_encode(item, out)
+    elif isinstance(obj, dict):
+        out += _msgpack_container_header(0x80, len(obj))
+        for key, value in obj.items():
+            _msgpack_encode(key, out)
+            _msgpack_encode(value, out)
+    elif isinstance(obj, ExtType):
+        out += _msgpack_ext(obj.code, obj.data)
+    else:
+        out += _msgpack_immediate(obj)
+
+
+def _transcode_mashpack(reader, out, flush=None, flush_size=_DEFAULT_CHUNK_SIZE):
+    buf, i, end = reader._refill(reader._i, 0)
+
+    # Open containers as [remaining, data_type]
+    stack = [[1, None]]
+    while True:
+        while not stack[-1][0]:
+            stack.pop()
+            if not stack:
+                reader._i = i
+                return
+        frame = stack[-1]
+        frame[0] -= 1
+        if flush is not None and len(out) >= flush_size:
+            flush(out)
+            out.clear()
+
+        # Elements of a typed ARRAY share the header byte of the array.
+        b = frame[1]
+        if b is None:
+            if i >= end:
+                buf, i, end = reader._refill(i, 1)
+            b = buf[i]
+            i += 1
+
+        immediate = _MASHPACK_IMMEDIATES[b]
+        if immediate is not None:
+            out += immediate
+
+        # MAPP, STRP, MARRAYP
+        elif b <= 0x3F:
+            out += _msgpack_container_header(0x80, b)
+            stack.append([2 * b, None])
+        elif b <= 0x7F:
+            n = b & 0x3F
+            if i + n > end:
+                buf, i, end = reader._refill(i, n)
+            out += _msgpack_str_header(n)
+            out += buf[i:i + n]
+            i += n
+        elif b <= 0x9F:
+            out += _msgpack_container_header(0x90, b & 0x1F)
+            stack.append([b & 0x1F, None])
+
+        # FLOAT32 and FLOAT64 are copied as they are.
+        elif b == 0xD9 or b == 0xDA:
+            n = 4 if b == 0xD9 else 8
+            if i + n > end:
+                buf, i, end = reader._refill(i, n)
+            out.append(0xCA if b == 0xD9 else 0xCB)
+            out += buf[i:i + n]
+            i += n
+        elif b in _MASHPACK_INTS:
+            st = _MASHPACK_INTS[b]
+            if i + st.size > end:
+                buf, i, end = reader._refill(i, st.size)
+            out += _msgpack_int(st.unpack_from(buf, i)[0])
+            i += st.size
+
+        elif 0xC2 <= b <= 0xDD:
+            reader._i = i
+            container = _transcode_mashpack_sized(reader, out, b)
+            buf, i, end = reader._refill(reader._i, 0)
+            if container is not None:
+                stack.append(container)
+        else:
+            raise ValueError(f'invalid Mashpack header byte 0x{b:02X}')
+
+
+def _transcode_mashpack_sized(reader, out, b):
+    # Transcodes the Mashpack types with a length after their header byte.
+    # Returns the frame to push for containers that have elements left.
+    n = reader.unpack((_STRUCT_UINT8, _STRUCT_UINT16, _STRUCT_UINT32)[(b - 0xDB if b >= 0xDB else b - 0xC2) % 3])
+
+    # MAP8, MAP16, MAP32
+    if b <= 0xC4:
+        out += _msgpack_container_header(0x80, n)
+        return [2 * n, None]
+
+    # STR8, STR16, STR32
+    elif b <= 0xC7:
+        out += _msgpack_str_header(n)
+        out += reader.read(n)
+
+    # ARRAY8, ARRAY16, ARRAY32
+    elif b <= 0xCA:
+        data_type = reader.unpack(_STRUCT_UINT8)
+        out += _msgpack_container_header(0x90, n)
+
+        # Elements with a fixed width are converted all at once
+        code = _TYPED_ARRAY_CODES.get(data_type)
+        if code == 'f':
+            data = reader.read(4 * n)
+            for i in range(0, 4 * n, 4):
+                out.append(0xCA)
+                out += data[i:i + 4]
+        elif code is not None:
+            for value in struct.unpack(f'>{n}{code}', reader.read(n * struct.calcsize(code))):
+                out += _msgpack_immediate(value)
+        else:
+            return [n, data_type]
+
+    # MARRAY8, MARRAY16, MARRAY32
+    elif b <= 0xCD:
+        out += _msgpack_container_header(0x90, n)
+        return [n, None]
+
+    # BIN8, BIN16, BIN32
+    elif b <= 0xD0:
+        out += _sized_header(0xC4, n)
+        out += reader.read(n)
+
+    # EXT8, EXT16, EXT32
+    else:
+        code = reader.unpack(_STRUCT_UINT8)
+        data = reader.read(n)
+        if code < 0x80:
+            out += _msgpack_ext(code, data)
+        elif code == _EXT_REF:
+            raise ValueError('REF extensions can not be transcoded to msgpack')
+        else:
+            # Reserved extension codes are unpacked from their own buffer.
+            unpacker = Unpacker(None)
+            unpacker.feed(_sized_header(0xDB, n) + bytes((code,)) + data)
+            _msgpack_encode(unpacker.unpack(), out)
+    return None
+
+
+class _ByteReader(object):
+    def __init__(self, data=None, fp=None, chunk_size=_DEFAULT_CHUNK_SIZE):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buffer = bytearray() if fp is not None else memoryview(data).cast('B')
+        self._i = 0
+
+    def at_end(self):
+        if self._i < len(self._buffer):
+            return False
+        try:
+            self._reserve(1)
+        except ValueError:
+            return True
+        return False
+
+    def byte(self):
+        self._reserve(1)
+        self._i += 1
+        return self._buffer[self._i - 1]
+
+    def read(self, n):
+        self._reserve(n)
+        self._i += n
+        return self._buffer[self._i - n:self._i]
+
+    def unpack(self, st):
+        self._reserve(st.size)
+        ret, = st.unpack_from(self._buffer, self._i)
+        self._i += st.size
+        return ret
+
+    def _refill(self, i, n):
+        self._i = i
+        self._reserve(n)
+        return self._buffer, self._i, len(self._buffer)
+
+    def _reserve(self, n):
+        if self._i + n <= len(self._buffer):
+            return
+        if self._fp is not None:
+            del self._buffer[:self._i]
+            self._i = 0
+            while len(self._buffer) < n:
+                data = self._fp.read(max(self._chunk_size, n - len(self._buffer)))
+                if not data:
+                    break
+                self._buffer += data
+            if len(self._buffer) >= n:
+                return
+        raise ValueError('incomplete data')
+
+
+class _JSONReader(object):
+    def __init__(self, fp, chunk_size):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buffer = ''
+        self._i = 0
+        self._eof = False
+
+    def events(self):
+        # Whether each open container is a map
+        stack = []
+        while True:
+            c = self._next_char()
+            value = self._scan() if c else _NO_VALUE
+            if value is not _NO_VALUE:
+                yield _EVENT_VALUE, value
+            elif c == '{' or c == '[':
+                self._i += 1
+                is_map = c == '{'
+                yield (_EVENT_START_MAP if is_map else _EVENT_START_ARRAY), None
+                if self._next_char() == ('}' if is_map else ']'):
+                    self._i += 1
+                    yield _EVENT_END, None
+                else:
+                    stack.append(is_map)
+                    if is_map:
+                        yield _EVENT_VALUE, self._read_key()
+                    continue
+            elif c or stack:
+                yield _EVENT_VALUE, self._read_scalar(c)
+            else:
+                return
+
+            # Reading the delimiter after a value and any containers it closes
+            while stack:
+                c = self._next_char()
+                if c == ',':
+                    self._i += 1
+                    if stack[-1]:
+                        yield _EVENT_VALUE, self._read_key()
+                    break
+                elif c == ('}' if stack[-1] else ']'):
+                    self._i += 1
+                    stack.pop()
+                    yield _EVENT_END, None
+                else:
+                    self._error("Expecting ',' delimiter")
+
+    def _scan(self):
+        # Values that end within the buffer are read whole by json's scanner
+        # so containers are only constructed up to the size of the buffer.
+        # Anything else, including invalid JSON, is read one token at a time.
+        try:
+            value, end = _scan_json(self._buffer, self._i)
+        except (StopIteration, ValueError):
+            return _NO_VALUE
+        # A number may continue past the end of the buffer.
+        if not self._eof and _JSON_NUMBER_CHARS.match(self._buffer, end).end() == len(self._buffer):
+            return _NO_VALUE
+        self._i = end
+        return value
+
+    def _read_key(self):
+        if self._next_char() != '"':
+            self._error('Expecting property name enclosed in double quotes')
+        key = self._read_str()
+        if self._next_char() != ':':
+            self._error("Expecting ':' delimiter")
+        self._i += 1
+        return key
+
+    def _read_scalar(self, c):
+        if c == '"':
+            return self._read_str()
+        elif c in _JSON_LITERALS:
+            literal, value = _JSON_LITERALS[c]
+            self._fill(len(literal))
+            if self._buffer.startswith(literal, self._i):
+                self._i += len(literal)
+                return value
+        else:
+            # Numbers may continue past the end of the buffer
+            while not self._eof and _JSON_NUMBER_CHARS.match(self._buffer, self._i).end() == len(self._buffer):
+                self._fill(2 * (len(self._buffer) - self._i))
+            match = _JSON_NUMBER.match(self._buffer, self._i)
+            if match is not None:
+                self._i = match.end()
+                if match.group(1) or match.group(2):
+                    return float(match.group())
+                return int(match.group())
+        self._error('Expecting value')
+
+    def _read_str(self):
+        while True:
+            try:
+                value, i = scanstring(self._buffer, self._i + 1)
+                self._i = i
+                return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+                self._fill(2 * (len(self._buffer) - self._i))
+
+    def _next_char(self):
+        while True:
+            self._i = _JSON_WHITESPACE.match(self._buffer, self._i).end()
+            if self._i < len(self._buffer) or self._eof:
+                return self._buffer[self._i:self._i + 1]
+            self._fill(1)
+
+    def _fill(self, n):
+        # Drops everything before the current position and
+        # reads until there are at least n characters left.
+        if self._i:
+            self._buffer = self._buffer[self._i:]
+            self._i = 0
+        while len(self._buffer) < n and not self._eof:
+            data = self._fp.read(max(self._chunk_size, n - len(self._buffer)))
+            if not data:
+                self._eof = True
+            self._buffer += data
+
+    def _error(self, msg):
+        raise json.JSONDecodeError(msg, self._buffer, self._i)
+
+
+class _MashpackWriter(object):
+    def __init__(self, fp, spill_size):
+        self._fp = self._out = fp
+        self._spill_size = spill_size
+        self._packer = Packer()
+
+        # Output that can't seek back to the headers of spilled containers
+        # is spilled to a temporary file until the top-level value is closed.
+        self._seekable = callable(getattr(fp, 'seekable', None)) and fp.seekable()
+        self._spill_file = None
+
+        # Open containers as [data, count, is_map, header_offset], data
+        # is None and header_offset is set once it's been spilled.
+        self._stack = []
+        self._buffered = 0
+
+    def value(self, obj):
+        self._write(self._packer.pack(obj))
+        if self._stack:
+            self._stack[-1][1] += 1
+
+    def start(self, is_map):
+        self._stack.append([bytearray(), 0, is_map, None])
+
+    def end(self):
+        data, count, is_map, header_offset = self._stack.pop()
+        if is_map:
+            count //= 2
+        if header_offset is None:
+            self._buffered -= len(data)
+            if is_map:
+                header = self._packer.pack_map_header(count)
+            else:
+                header = self._packer.pack_array_header(count)
+            self._write(header + data)
+        else:
+            offset = self._fp.tell()
+            self._fp.seek(header_offset)
+            self._fp.write(_STRUCT_UINT32.pack(count))
+            self._fp.seek(offset)
+        if self._stack:
+            self._stack[-1][1] += 1
+        elif self._fp is not self._out:
+            self._fp = self._out
+            self._spill_file.seek(0)
+            shutil.copyfileobj(self._spill_file, self._out)
+            self._spill_file.seek(0)
+            self._spill_file.truncate()
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+
+    def _write(self, data):
+        if self._stack and self._stack[-1][3] is None:
+            self._stack[-1][0] += data
+            self._buffered += len(data)
+            if self._buffered > self._spill_size:
+                self._spill()
+        else:
+            self._fp.write(data)
+
+    def _spill(self):
+        if not self._seekable:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile()
+            self._fp = self._spill_file
+
+        # Spilled containers are always the outermost ones.
+        for frame in self._stack:
+            if frame[3] is None:
+                self._fp.write(b'\xC4' if frame[2] else b'\xCD')
+                frame[3] = self._fp.tell()
+                self._fp.write(b'\x00\x00\x00\x00')
+                self._fp.write(frame[0])
+                frame[0] = None
+        self._buffered = 0
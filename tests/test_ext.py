@@ -0,0 +1,74 @@
+import datetime
+import decimal
+import pytest
+import uuid
+from mashpack import ExtType, packb, unpackb
+from mashpack.ext import ExtRegistry
+
+
+@pytest.mark.parametrize('obj', [
+    datetime.datetime(2018, 1, 22, 12, 30, 15, 123456),
+    datetime.datetime(1, 1, 1),
+    datetime.datetime(2018, 1, 22, 12, 30, tzinfo=datetime.timezone.utc),
+    datetime.datetime(2018, 1, 22, 12, 30, tzinfo=datetime.timezone(datetime.timedelta(hours=-5, minutes=-30))),
+    decimal.Decimal('3.14159265358979323846'),
+    decimal.Decimal('-Infinity'),
+    uuid.UUID('12345678-1234-5678-1234-567812345678'),
+])
+def test_ext_registry_builtins(obj, packer_type, unpacker_type):
+    registry = ExtRegistry()
+    unpacker = unpacker_type(ext_registry=registry)
+    unpacker.feed(packer_type(ext_registry=registry).pack([obj]))
+    ret, = unpacker.unpack()
+    assert type(ret) is type(obj)
+    assert ret == obj
+    if isinstance(obj, datetime.datetime):
+        assert ret.utcoffset() == obj.utcoffset()
+
+
+def test_ext_registry_decoder_receives_memoryview(packer_type, unpacker_type):
+    registry = ExtRegistry(builtins=False)
+    registry.register(1, complex, lambda obj: f'{obj.real},{obj.imag}'.encode(), None)
+    data = packer_type(ext_registry=registry).pack(1+2j)
+    assert data == b'\xDB\x07\x011.0,2.0'
+
+    views = []
+    registry.register(1, decode=lambda view: views.append(view) or complex(*map(float, bytes(view).split(b','))))
+    unpacker = unpacker_type(ext_registry=registry)
+    unpacker.feed(data)
+    assert unpacker.unpack() == 1+2j
+    assert isinstance(views[0], memoryview)
+
+
+def test_ext_registry_is_copied(packer_type, unpacker_type):
+    registry = ExtRegistry(builtins=False)
+    packer = packer_type(ext_registry=registry)
+    unpacker = unpacker_type(ext_registry=registry)
+    registry.register(1, complex, lambda obj: b'', lambda view: 0j)
+
+    with pytest.raises(TypeError):
+        packer.pack(1j)
+    unpacker.feed(b'\xDB\x00\x01')
+    assert unpacker.unpack() == ExtType(1, b'')
+
+
+def test_ext_registry_registered_after_packb():
+    registry = ExtRegistry(builtins=False)
+    assert packb(1, ext_registry=registry) == packb(1)
+    assert unpackb(b'\xDB\x00\x01', ext_registry=registry) == ExtType(1, b'')
+    registry.register(1, complex, lambda obj: b'', lambda view: 0j)
+
+    assert packb(1j, ext_registry=registry) == b'\xDB\x00\x01'
+    assert unpackb(b'\xDB\x00\x01', ext_registry=registry) == 0j
+
+
+def test_ext_registry_invalid():
+    registry = ExtRegistry()
+    with pytest.raises(ValueError):
+        registry.register(0x86, decode=bytes)
+    with pytest.raises(ValueError):
+        registry.register(1, complex)
+    with pytest.raises(ValueError):
+        registry.register(1)
+    with pytest.raises(TypeError):
+        registry.register(1, decode=1)
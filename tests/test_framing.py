@@ -0,0 +1,53 @@
+import io
+import pytest
+from mashpack.framing import BlockWriter, BlockReader
+
+
+@pytest.mark.parametrize('codec', ['none', 'zlib', 'lzma', 'bz2'])
+def test_block_write_and_read(codec):
+    records = [{'id': i, 'name': f'user{i}', 'tags': ['a', 'b'] * (i % 5)} for i in range(1000)]
+    f = io.BytesIO()
+    with BlockWriter(f, codec=codec, block_size=4096, max_workers=4) as writer:
+        for record in records:
+            writer.write(record)
+
+    f.seek(0)
+    with BlockReader(f, max_workers=4) as reader:
+        assert list(reader) == records
+
+
+def test_block_index_and_read_block():
+    f = io.BytesIO()
+    with BlockWriter(f, block_size=1024) as writer:
+        for i in range(500):
+            writer.write([i] * 10)
+
+    f.seek(0)
+    reader = BlockReader(f)
+    blocks = reader.index()
+    assert len(blocks) > 1
+    assert sum(block.records for block in blocks) == 500
+    assert reader.read_block(blocks[1].offset)[0] == [blocks[0].records] * 10
+    reader.close()
+
+
+def test_block_checksum_mismatch():
+    f = io.BytesIO()
+    with BlockWriter(f) as writer:
+        writer.write('x' * 100)
+
+    data = bytearray(f.getvalue())
+    data[-1] ^= 0xFF
+    with pytest.raises(ValueError):
+        list(BlockReader(io.BytesIO(bytes(data))))
+
+
+def test_block_process_pool():
+    from concurrent.futures import ProcessPoolExecutor
+    f = io.BytesIO()
+    with ProcessPoolExecutor(2) as executor:
+        with BlockWriter(f, block_size=256, executor=executor) as writer:
+            for i in range(100):
+                writer.write({'i': i})
+        f.seek(0)
+        assert list(BlockReader(f, executor=executor)) == [{'i': i} for i in range(100)]
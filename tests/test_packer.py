@@ -1,5 +1,11 @@
+import collections
+import dataclasses
+import io
+import pytest
 import struct
-from mashpack import ExtType
+import threading
+from mashpack import ExtType, encoded_size, packb, unpackb
+from mashpack.exceptions import PackValueError
 
 
 def test_pack_ext8(packer):
@@ -12,3 +18,382 @@ def test_pack_ext16(packer):
 
 def test_pack_ext32(packer):
     assert packer.pack(ExtType(127, b'\x00' * 0x10000)) == b'\xDD' + struct.pack('>I', 0x10000) + b'\x7F' + (b'\x00' * 0x10000)
+
+
+def test_pack_canonical_sorts_keys(packer_type):
+    packer = packer_type(canonical=True)
+    assert packer.pack({'b': 1, 'a': 2, 'aa': 3}) == b'\x03\x41a\xa2\x41b\xa1\x42aa\xa3'
+    assert packer.pack({'aa': 3, 'b': 1, 'a': 2}) == packer.pack({'b': 1, 'a': 2, 'aa': 3})
+    assert packer.pack({'z': {}, 1: [], 'y': None}) == b'\x03\x41y\xdf\x41z\x00\xa1\x80'
+
+
+def test_pack_canonical_equal_keys_of_other_types(packer_type):
+    # Keys that are equal but encoded differently don't share a key order.
+    packer = packer_type(canonical=True)
+    assert packer.pack({1: 'a'}) == b'\x01\xa1\x41a'
+    assert packer.pack({1.0: 'a'}) == b'\x01\xd9\x3f\x80\x00\x00\x41a'
+    assert packer.pack({True: 'a'}) == b'\x01\xc1\x41a'
+    assert packer.pack({1: 'a', 16: 'b'}) == b'\x02\xa1\x41a\xb0\x41b'
+    assert packer.pack({True: 'a', 16: 'b'}) == b'\x02\xb0\x41b\xc1\x41a'
+    assert packer.pack({0.0: 'a'}) == b'\x01\xd9\x00\x00\x00\x00\x41a'
+    assert packer.pack({-0.0: 'a'}) == b'\x01\xd9\x80\x00\x00\x00\x41a'
+
+
+def test_pack_canonical_smallest_float(packer_type):
+    packer = packer_type(canonical=True)
+    assert packer.pack(1.5) == b'\xD9' + struct.pack('>f', 1.5)
+    assert packer.pack(0.1) == b'\xDA' + struct.pack('>d', 0.1)
+
+
+def test_pack_refs_to_repeated_objects(packer_type, unpacker_type):
+    config = {'name': 'default', 'retries': [1, 2, 4, 8], 'timeout': 30}
+    obj = [config, {'config': config}, config]
+
+    data = packer_type(use_refs=True).pack(obj)
+    assert len(data) < len(packer_type().pack(obj))
+    assert data.count(b'\xDB\x01\x80\x01') == 2
+
+    unpacker = unpacker_type()
+    unpacker.feed(data)
+    assert unpacker.unpack() == obj
+
+    unpacker = unpacker_type(shared_refs=True)
+    unpacker.feed(data)
+    ret = unpacker.unpack()
+    assert ret == obj
+    assert ret[1]['config'] is ret[2]
+
+
+def test_unpack_refs_to_open_containers(unpacker):
+    unpacker.feed(b'\x83\xa1\xa1\xdb\x01\x80\x00')
+    with pytest.raises(ValueError):
+        unpacker.unpack()
+
+
+@pytest.mark.parametrize('read_size', [0, 16])
+def test_unpack_refs_one_element_at_a_time(packer_type, unpacker_type, read_size):
+    config = {'name': 'default', 'retries': [1, 2, 4, 8], 'timeout': 30}
+    obj = [config, [{'config': config}], config]
+    data = packer_type(use_refs=True).pack(obj)
+
+    unpacker = unpacker_type(io.BytesIO(data * 2), read_size=read_size)
+    for _ in range(2):
+        assert unpacker.read_array_header() == 3
+        assert unpacker.unpack() == config
+        assert unpacker.read_array_header() == 1
+        assert unpacker.unpack() == {'config': config}
+        assert unpacker.unpack() == config
+    assert unpacker.tell() == 2 * len(data)
+
+
+def test_unpack_raw_fields_with_refs(packer_type, unpacker_type):
+    # Raw values don't keep references to objects outside of them.
+    config = {'name': 'default', 'retries': [1, 2, 4, 8]}
+    data = packer_type(use_refs=True).pack([config, {'x': config}])
+    unpacker = unpacker_type(raw_fields=['x'])
+    unpacker.feed(data)
+    _, record = unpacker.unpack()
+
+    unpacker = unpacker_type()
+    unpacker.feed(packer_type().pack({'y': record['x']}))
+    assert unpacker.unpack() == {'y': config}
+
+
+def test_pack_columnar_records(packer_type, unpacker_type):
+    records = [{'id': i, 'score': i / 2, 'name': f'user{i}', 'delta': -i} for i in range(100)]
+    data = packer_type(use_columnar=True).pack(records)
+    assert data[0] == 0xDC and data[3] == 0x81
+    assert len(data) < len(packer_type().pack(records)) // 2
+
+    unpacker = unpacker_type()
+    unpacker.feed(data)
+    assert unpacker.unpack() == records
+
+    unpacker = unpacker_type(columnar='lists')
+    unpacker.feed(data)
+    columns = unpacker.unpack()
+    assert list(columns) == ['id', 'score', 'name', 'delta']
+    assert columns['id'] == list(range(100))
+    assert columns['name'] == [f'user{i}' for i in range(100)]
+
+    unpacker = unpacker_type(columnar='arrays')
+    unpacker.feed(data)
+    columns = unpacker.unpack()
+    assert columns['delta'].tolist() == [-i for i in range(100)]
+    assert columns['score'].typecode == 'd'
+
+
+def test_pack_columnar_rows_use_map_options(packer_type, unpacker_type):
+    Row = collections.namedtuple('Row', ['name', 'tags'])
+    records = [{'name': f'user{i}', 'tags': ['a', str(i)]} for i in range(3)]
+    data = packer_type(use_columnar=True).pack(records)
+
+    def unpack(**kwargs):
+        unpacker = unpacker_type(**kwargs)
+        unpacker.feed(data)
+        return unpacker.unpack()
+
+    assert unpack(object_pairs_hook=list) == [[('name', f'user{i}'), ('tags', ['a', str(i)])] for i in range(3)]
+    assert unpack(classes=[Row]) == [Row(f'user{i}', ['a', str(i)]) for i in range(3)]
+    assert unpack(schema=('tags', 'name')) == [(['a', str(i)], f'user{i}') for i in range(3)]
+    assert unpack(list_hook=tuple) == tuple({'name': f'user{i}', 'tags': ('a', str(i))} for i in range(3))
+
+
+def test_pack_columnar_canonical(packer_type):
+    packer = packer_type(use_columnar=True, canonical=True)
+    data = packer.pack([{'b': 1, 'a': 2}, {'a': 3, 'b': 4}])
+    assert data == packer.pack([{'a': 2, 'b': 1}, {'b': 4, 'a': 3}])
+    assert data[:3] == b'\xDB\x10\x81' and data.index(b'\x41a') < data.index(b'\x41b')
+    assert packer.pack([{1: 'x'}, {True: 'y'}])[:1] == b'\x82'
+
+
+@pytest.mark.parametrize('columnar', ['rows', 'lists', 'arrays'])
+@pytest.mark.parametrize('payload', [
+    b'\xA2\x81Aa\xCE\x03Z\x00\x00',
+    b'\xA2\x81Aa\xCE\x02B\x00',
+    b'\xA2\x81Aa\xCE\x04B\x00\x00\x00',
+    b'\xA2\x81\x80\xCE\x03B\x00\x00',
+    b'\xA2\x82AaAa\xCE\x03B\x00\x00\xCE\x03B\x00\x00',
+    b'\x41a\x81Aa\xCE\x03B\x00\x00',
+])
+def test_unpack_columnar_invalid(columnar, payload, unpacker_type):
+    unpacker = unpacker_type(columnar=columnar)
+    unpacker.feed(b'\xDB' + bytes([len(payload)]) + b'\x81' + payload)
+    with pytest.raises(ValueError):
+        unpacker.unpack()
+
+
+@pytest.mark.parametrize('key', [True, 1.0])
+def test_pack_columnar_keys_of_other_types(key, packer_type, unpacker_type):
+    obj = [{1: 'x'}, {key: 'y'}]
+    unpacker = unpacker_type()
+    unpacker.feed(packer_type(use_columnar=True).pack(obj))
+    ret = unpacker.unpack()
+    assert ret == obj
+    assert [type(k) for row in ret for k in row] == [int, type(key)]
+
+
+@pytest.mark.parametrize('obj', [
+    list(range(1_600_000_000_000, 1_600_000_100_000, 1000)),
+    [2**40 + i * 7 + (i % 3) for i in range(50)],
+    [10, 3, 4, 1000, -5, 0, 9],
+])
+def test_pack_delta_int_arrays(obj, packer_type, unpacker_type):
+    data = packer_type(use_delta=True).pack(obj)
+    assert len(data) <= len(packer_type().pack(obj))
+
+    unpacker = unpacker_type()
+    unpacker.feed(data)
+    assert unpacker.unpack() == obj
+
+
+def test_pack_delta_integers_out_of_range(packer_type):
+    obj = [0, 2**63 - 1, 2 * (2**63 - 1), 3 * (2**63 - 1)]
+    with pytest.raises(PackValueError):
+        packer_type(use_delta=True).pack(obj)
+
+
+def test_pack_delta_picks_constant_step(packer_type):
+    data = packer_type(use_delta=True).pack(list(range(1_600_000_000_000, 1_600_000_100_000, 1000)))
+    assert data == b'\xDB\x15\x82' + struct.pack('>IqqB', 100, 1_600_000_000_000, 1000, 0)
+
+
+@pytest.mark.parametrize('payload', [
+    b'',
+    struct.pack('>IqqB', 0, 1, 1, 0),
+    struct.pack('>IqqB', 3, 1, 1, 3) + b'\x00' * 6,
+    struct.pack('>IqqB', 3, 1, 1, 1) + b'\x00',
+    struct.pack('>IqqB', 3, 1, 1, 0) + b'\x00',
+])
+def test_unpack_delta_invalid(payload, unpacker_type):
+    unpacker = unpacker_type()
+    unpacker.feed(b'\xDB' + bytes([len(payload)]) + b'\x82' + payload)
+    with pytest.raises(ValueError):
+        unpacker.unpack()
+
+
+def test_pack_bitmap_bool_arrays(packer_type, unpacker_type):
+    obj = [i % 3 == 0 for i in range(100)]
+    data = packer_type(use_bitmap=True).pack(obj)
+    assert data[:7] == b'\xDB\x11\x83\x00\x00\x00\x64'
+    assert data[7] == 0b01001001
+
+    unpacker = unpacker_type()
+    unpacker.feed(data)
+    assert unpacker.unpack() == obj
+
+
+@pytest.mark.parametrize('obj', [
+    [None if i % 5 == 0 else i * 1000 for i in range(40)],
+    [None if i % 5 == 0 else i / 3 for i in range(30)],
+    [None] * 20,
+])
+def test_pack_bitmap_nullable_arrays(obj, packer_type, unpacker_type):
+    data = packer_type(use_bitmap=True).pack(obj)
+    assert data[2] == 0x84
+    assert len(data) < len(packer_type().pack(obj))
+
+    unpacker = unpacker_type()
+    unpacker.feed(data)
+    assert unpacker.unpack() == obj
+
+
+@pytest.mark.parametrize('code, payload', [
+    (0x83, b'\x00\x00'),
+    (0x83, b'\x00\x00\x00\x09\x01'),
+    (0x84, b'\x00\x00\x00\x01'),
+    (0x84, b'\x00\x00\x00\x01x\x01'),
+    (0x84, b'\x00\x00\x00\x02B\x03\x01'),
+])
+def test_unpack_bitmap_invalid(code, payload, unpacker_type):
+    unpacker = unpacker_type()
+    unpacker.feed(b'\xDB' + bytes([len(payload), code]) + payload)
+    with pytest.raises(ValueError):
+        unpacker.unpack()
+
+
+@pytest.mark.parametrize('payload', [
+    b'\x81\x41a\xCE\x00',
+    b'\x81\x41a\xCE\x02Z\x00',
+    b'\x81\x41a\xCE\x02B\x01',
+    b'\x81\x41a\xCE\x02x\x00',
+    b'\x81\x41a\xCE\x02H\x00',
+    b'\x81\xA1\xCE\x02B\x00',
+])
+def test_unpack_dictionary_invalid(payload, unpacker_type):
+    unpacker = unpacker_type()
+    unpacker.feed(b'\xDB' + bytes([len(payload)]) + b'\x85' + payload)
+    with pytest.raises(ValueError):
+        unpacker.unpack()
+
+
+def test_pack_dictionary_str_arrays(packer_type, unpacker_type):
+    obj = ['us-east', 'us-west', 'eu-central', 'us-east'] * 25
+    data = packer_type(use_dictionary=True).pack(obj)
+    assert data[:3] == b'\xDB\x83\x85'
+    assert len(data) < len(packer_type().pack(obj)) // 5
+
+    unpacker = unpacker_type()
+    unpacker.feed(data)
+    ret = unpacker.unpack()
+    assert ret == obj
+    assert ret[0] is ret[3]
+
+
+def test_pack_dictionary_list_hook(packer_type, unpacker_type):
+    obj = [['us-east', 'eu-central'] * 4]
+    unpacker = unpacker_type(list_hook=tuple)
+    unpacker.feed(packer_type(use_dictionary=True).pack(obj))
+    assert unpacker.unpack() == (('us-east', 'eu-central') * 4,)
+
+
+def test_pack_dictionary_skips_distinct_strs(packer_type):
+    obj = ['a', 'b', 'c', 'd', 'e']
+    assert packer_type(use_dictionary=True).pack(obj) == packer_type().pack(obj)
+
+
+def test_pack_float32_auto(packer_type):
+    packer = packer_type(use_float32='auto')
+    assert packer.pack(0.25) == b'\xD9' + struct.pack('>f', 0.25)
+    assert packer.pack(0.1) == b'\xDA' + struct.pack('>d', 0.1)
+    assert packer.pack([0.5, 1.5, -2.0, 1e10]) == b'\xC8\x04\xD9' + struct.pack('>4f', 0.5, 1.5, -2.0, 1e10)
+    assert packer.pack([0.5, 1.5, -2.0, 0.1])[:1] == b'\x84'
+
+
+
+@pytest.mark.parametrize('use_float32', [True, 'auto'])
+def test_pack_float32_columns(use_float32, packer_type, unpacker_type):
+    # Columns are narrowed the same way as NULLABLE arrays.
+    obj = [{'v': 0.5}, {'v': 1.25}]
+    data = packer_type(use_columnar=True, use_float32=use_float32).pack(obj)
+    assert data.endswith(b'\xCE\x09f' + struct.pack('>2f', 0.5, 1.25))
+    unpacker = unpacker_type()
+    unpacker.feed(data)
+    assert unpacker.unpack() == obj
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+    label: str = ''
+
+
+class Slotted(object):
+    __slots__ = ('b', 'a')
+
+    def __init__(self, b, a):
+        self.b = b
+        self.a = a
+
+
+Pair = collections.namedtuple('Pair', ['key', 'value'])
+
+
+def test_pack_classes(packer_type):
+    packer = packer_type(classes=[Point, Slotted, Pair])
+    obj = [Point(1, 2, 'p'), Slotted(Pair('k', 3), None)]
+    assert packer.pack(obj) == packer_type().pack([
+        {'x': 1, 'y': 2, 'label': 'p'},
+        {'b': {'key': 'k', 'value': 3}, 'a': None}
+    ])
+
+    canonical = packer_type(classes=[Slotted], canonical=True)
+    assert canonical.pack(Slotted(1, 2)) == b'\x02\x41a\xA2\x41b\xA1'
+
+
+def test_pack_classes_not_supported(packer_type):
+    with pytest.raises(TypeError):
+        packer_type(classes=[object])
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'canonical': True},
+    {'use_refs': True, 'use_columnar': True},
+    {'use_delta': True, 'use_bitmap': True, 'use_dictionary': True, 'use_float32': 'auto'},
+])
+def test_encoded_size(packer_type, options):
+    row = {'id': 1, 'tags': ['a', 'b', 'a', 'b'], 'scores': [0.5, 1.5, None, 2.5] * 3}
+    obj = {'rows': [dict(row, id=i) for i in range(10)], 'same': [row, row], 'data': b'x' * 300}
+    assert encoded_size(obj, **options) == len(packer_type(**options).pack(obj))
+
+
+def test_encoded_size_limit():
+    obj = ['x' * 100] * 100
+    assert encoded_size(obj, limit=20000) == encoded_size(obj)
+    size = encoded_size(obj, limit=500)
+    assert 500 < size < 700
+
+
+def test_packb_from_threads():
+    results = {}
+
+    def pack_all(i):
+        results[i] = [packb({'i': i, 'j': j}, use_float32=True) for j in range(200)]
+
+    threads = [threading.Thread(target=pack_all, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i, packed in results.items():
+        assert [unpackb(data) for data in packed] == [{'i': i, 'j': j} for j in range(200)]
+
+
+def test_packb_keeps_caches():
+    # Pooled packers keep their class encoders and canonical key orders.
+    from mashpack._fallback import Packer, _pool
+    options = {'classes': (Slotted,), 'canonical': True}
+    packb(Slotted(1, 2), **options)
+    packb([Slotted({'b': 1, 'a': 2}, 3)], **options)
+    packer = _pool.instances[Packer, frozenset(options.items())]
+    assert list(packer._class_encoders) == [Slotted]
+    assert packer._canonical_key_orders
+
+
+def test_packb_reentrant_default():
+    # The packer in use isn't reused by calls from within default.
+    default = lambda obj: ExtType(1, packb(sorted(obj), default=default))
+    assert packb([{1}, {2: {3}}], default=default) == packb(
+        [ExtType(1, packb([1])), {2: ExtType(1, packb([3]))}]
+    )
@@ -0,0 +1,73 @@
+import multiprocessing
+import pytest
+import queue
+
+pytest.importorskip('multiprocessing.shared_memory', reason='requires Python 3.8 or later')
+
+from mashpack import shm  # noqa: E402
+from mashpack.shm import RingBuffer  # noqa: E402
+
+
+@pytest.fixture
+def ring():
+    ring = RingBuffer(64)
+    yield ring
+    ring.close()
+    ring.unlink()
+
+
+def test_ring_buffer_wraps_around(ring):
+    for i in range(100):
+        ring.put({'i': i, 's': 'x' * (i % 20)})
+        assert ring.get() == {'i': i, 's': 'x' * (i % 20)}
+
+
+def test_ring_buffer_backpressure(ring):
+    ring.put('x' * 40)
+    with pytest.raises(queue.Full):
+        ring.put('x' * 40, timeout=0.01)
+    with pytest.raises(ValueError):
+        ring.put('x' * 100)
+    assert ring.get() == 'x' * 40
+    with pytest.raises(queue.Empty):
+        ring.get(block=False)
+
+
+def test_ring_buffer_frame_too_large(ring, monkeypatch):
+    # Frame lengths are 32-bit so larger objects are rejected before the ring's size.
+    monkeypatch.setattr(shm, '_MAX_FRAME_LEN', 8)
+    with pytest.raises(ValueError, match='too large'):
+        ring.put('x' * 10)
+    ring.put('x' * 4)
+    assert ring.get() == 'x' * 4
+
+
+def _produce(ring, start):
+    for i in range(start, start + 200):
+        ring.put([i, 'x' * (i % 30)])
+    ring.close()
+
+
+def _consume(ring, results):
+    for _ in range(200):
+        results.put(ring.get()[0])
+    ring.close()
+
+
+@pytest.mark.parametrize('method', ['fork', 'spawn'])
+def test_ring_buffer_between_processes(method):
+    ctx = multiprocessing.get_context(method)
+    ring = RingBuffer(256, ctx=ctx)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=_produce, args=(ring, i * 1000)) for i in range(2)]
+    processes += [ctx.Process(target=_consume, args=(ring, results)) for _ in range(2)]
+    try:
+        for process in processes:
+            process.start()
+        received = sorted(results.get(timeout=30) for _ in range(400))
+        for process in processes:
+            process.join()
+        assert received == list(range(200)) + list(range(1000, 1200))
+    finally:
+        ring.close()
+        ring.unlink()
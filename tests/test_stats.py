@@ -0,0 +1,67 @@
+import io
+from mashpack.stats import Stats
+
+
+def test_stats_pack(packer_type):
+    stats = Stats()
+    packer = packer_type(stats=stats, default=sorted)
+    packer.pack({'a': 'x' * 100, 'b': {3, 1, 2}})
+    packer.pack([None] * 40)
+
+    snapshot = stats.snapshot()['pack']
+    assert snapshot['types']['MAPP'] == {'count': 1, 'bytes': 1}
+    assert snapshot['types']['STRP'] == {'count': 2, 'bytes': 4}
+    assert snapshot['types']['STR8'] == {'count': 1, 'bytes': 102}
+    assert snapshot['types']['INTP'] == {'count': 3, 'bytes': 3}
+    assert snapshot['types']['NULL'] == {'count': 40, 'bytes': 40}
+    assert snapshot['containers'] == {'MAP': {2: 1}, 'MARRAY': {4: 1, 64: 1}}
+    assert snapshot['hooks']['default']['calls'] == 1
+    assert snapshot['latency']['count'] == 2
+
+
+def test_stats_pack_headers(packer_type):
+    stats = Stats()
+    packer = packer_type(stats=stats, autoreset=False)
+    packer.pack_map_header(2)
+    packer.pack_array_header(300)
+    packer.pack_ext_header(1, 4)
+    packer.pack_map_pairs([('a', None)])
+
+    snapshot = stats.snapshot()['pack']
+    assert snapshot['types'] == {
+        'MAPP': {'count': 2, 'bytes': 2},
+        'MARRAY16': {'count': 1, 'bytes': 3},
+        'EXT8': {'count': 1, 'bytes': 3},
+        'STRP': {'count': 1, 'bytes': 2},
+        'NULL': {'count': 1, 'bytes': 1}
+    }
+    assert snapshot['containers'] == {'MAP': {1: 1, 2: 1}, 'MARRAY': {512: 1}}
+    assert snapshot['latency']['count'] == 1
+
+
+def test_stats_unpack(packer, unpacker_type):
+    stats = Stats()
+    data = packer.pack({'a': [1.5, 2.5]}) + packer.pack([1, 2])
+    unpacker = unpacker_type(io.BytesIO(data), stats=stats, list_hook=tuple)
+    assert list(unpacker) == [{'a': (1.5, 2.5)}, (1, 2)]
+
+    snapshot = stats.snapshot()['unpack']
+    assert snapshot['types']['FLOAT64'] == {'count': 2, 'bytes': 18}
+    assert snapshot['containers'] == {'MAP': {1: 1}, 'MARRAY': {2: 2}}
+    assert snapshot['hooks']['list_hook']['calls'] == 2
+    assert snapshot['latency']['count'] == 2
+    assert stats.snapshot()['pack']['latency']['count'] == 0
+
+    stats.reset()
+    assert stats.snapshot()['unpack']['types'] == {}
+
+
+def test_stats_typed_array(unpacker_type):
+    stats = Stats()
+    unpacker = unpacker_type(stats=stats)
+    unpacker.feed(b'\xC8\x03\xD6\x00\x01\x01\x00\xff\xff')
+    assert unpacker.unpack() == [1, 256, 65535]
+    assert stats.snapshot()['unpack']['types'] == {
+        'ARRAY8': {'count': 1, 'bytes': 3},
+        'UINT16': {'count': 3, 'bytes': 6}
+    }
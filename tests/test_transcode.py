@@ -0,0 +1,131 @@
+import io
+import json
+import pytest
+from mashpack import ExtType, Unpacker, packb, unpackb
+from mashpack.transcode import (
+    json_to_mashpack, json_to_mashpack_stream, mashpack_to_json, mashpack_to_json_stream,
+    msgpack_to_mashpack, msgpack_to_mashpack_stream, mashpack_to_msgpack, mashpack_to_msgpack_stream
+)
+
+DOCUMENT = {'a': [1, 2.5, -300, True, False, None, 'xé"\n'], 'b': {}, 'c': [], 'd': [{'e': 1e300}]}
+
+
+def test_json_to_mashpack():
+    assert json_to_mashpack(json.dumps(DOCUMENT)) == packb(DOCUMENT)
+
+
+def test_mashpack_to_json():
+    assert json.loads(mashpack_to_json(packb(DOCUMENT))) == DOCUMENT
+    assert mashpack_to_json(packb({1: [1.5, 2.5, 3.5, 4.5], None: True}, use_float32='auto')) == \
+        '{"1":[1.5,2.5,3.5,4.5],"null":true}'
+
+
+@pytest.mark.parametrize('spill_size', [1 << 20, 1000])
+def test_json_to_mashpack_stream(spill_size):
+    records = [{'id': i, 'name': 'n' * (i % 70), 'v': [i * 0.5] * 3} for i in range(1000)]
+    text = json.dumps(records, indent=1) + '\n' + json.dumps(DOCUMENT)
+    out = io.BytesIO()
+    json_to_mashpack_stream(io.StringIO(text), out, chunk_size=7, spill_size=spill_size)
+    data = out.getvalue()
+    if spill_size == 1000:
+        # The outer ARRAY and the open MAP were spilled with 32-bit headers.
+        assert data[0] == 0xCD
+    else:
+        assert data.startswith(packb(records))
+    assert list(Unpacker(io.BytesIO(data))) == [records, DOCUMENT]
+
+
+def test_json_to_mashpack_stream_not_seekable():
+    class Pipe(io.BytesIO):
+        def seekable(self):
+            return False
+
+    records = [{'id': i, 'v': [i] * 3} for i in range(200)]
+    text = json.dumps(records) + json.dumps(DOCUMENT)
+    out = Pipe()
+    json_to_mashpack_stream(io.StringIO(text), out, chunk_size=7, spill_size=100)
+    data = out.getvalue()
+    assert data[0] == 0xCD
+    assert list(Unpacker(io.BytesIO(data))) == [records, DOCUMENT]
+
+
+def test_mashpack_to_json_stream():
+    out = io.StringIO()
+    mashpack_to_json_stream(io.BytesIO(packb(DOCUMENT) + packb(5) + packb([])), out, read_size=3)
+    assert [json.loads(line) for line in out.getvalue().splitlines()] == [DOCUMENT, 5, []]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5])
+def test_json_to_mashpack_stream_numbers_across_chunks(chunk_size):
+    text = '[0.5, 12345, 1e10, -3, 2.5E-3, {"a": 10}] 7 -1.25'
+    out = io.BytesIO()
+    json_to_mashpack_stream(io.StringIO(text), out, chunk_size=chunk_size)
+    assert list(Unpacker(io.BytesIO(out.getvalue()))) == [[0.5, 12345, 1e10, -3, 2.5e-3, {'a': 10}], 7, -1.25]
+
+
+@pytest.mark.parametrize('text', [
+    '[1,]', '{"a" 1}', '{"a":1,}', '[1 2]', 'tru', '{', '"abc', '[1,2', 'NaN', '[Infinity]', '{"a": -Infinity}'
+])
+def test_json_to_mashpack_invalid(text):
+    with pytest.raises(json.JSONDecodeError):
+        json_to_mashpack(text)
+
+
+def test_mashpack_to_json_bin():
+    with pytest.raises(TypeError):
+        mashpack_to_json(packb(b'abc'))
+
+
+# msgpack encoding of {'a': [1, 200, -3, -200], 'bb': None, 'c': [True, 1.5, 'xyz', b'\x00'], 'e': ExtType(1, b'ab')}
+MSGPACK = (b'\x84\xa1a\x94\x01\xcc\xc8\xfd\xd1\xff\x38\xa2bb\xc0\xa1c\x94\xc3\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00'
+           b'\xa3xyz\xc4\x01\x00\xa1e\xd5\x01ab')
+MSGPACK_OBJ = {'a': [1, 200, -3, -200], 'bb': None, 'c': [True, 1.5, 'xyz', b'\x00'], 'e': ExtType(1, b'ab')}
+
+
+def test_msgpack_to_mashpack():
+    assert msgpack_to_mashpack(MSGPACK) == packb(MSGPACK_OBJ)
+
+
+def test_mashpack_to_msgpack():
+    assert mashpack_to_msgpack(packb(MSGPACK_OBJ)) == MSGPACK
+
+
+@pytest.mark.parametrize('obj', [
+    list(range(50)),
+    [True, False] * 10,
+    [1, None] * 10,
+    ['ab', 'cd'] * 10,
+    [{'a': 1, 'b': 'x'}] * 10,
+    [0.5, 1.5] * 5,
+])
+def test_mashpack_to_msgpack_reserved_ext(obj):
+    data = packb(obj, use_delta=True, use_bitmap=True, use_dictionary=True, use_columnar=True, use_float32='auto')
+    assert unpackb(msgpack_to_mashpack(mashpack_to_msgpack(data))) == obj
+
+
+def test_msgpack_to_mashpack_promote_arrays():
+    data = msgpack_to_mashpack(b'\x94\x01\x02\x03\xcd\x01\x2c', promote_arrays=True)
+    assert data == b'\xc8\x04\xd6\x00\x01\x00\x02\x00\x03\x01\x2c'
+    assert unpackb(data) == [1, 2, 3, 300]
+
+    # Arrays that aren't only numbers are left as they are.
+    assert msgpack_to_mashpack(b'\x94\x01\x02\x03\xc0', promote_arrays=True) == packb([1, 2, 3, None])
+    assert unpackb(msgpack_to_mashpack(MSGPACK, promote_arrays=True)) == MSGPACK_OBJ
+
+
+def test_msgpack_stream():
+    out = io.BytesIO()
+    msgpack_to_mashpack_stream(io.BytesIO(MSGPACK * 3), out, chunk_size=5)
+    assert out.getvalue() == packb(MSGPACK_OBJ) * 3
+
+    out = io.BytesIO()
+    mashpack_to_msgpack_stream(io.BytesIO(packb(MSGPACK_OBJ) * 3), out, chunk_size=5)
+    assert out.getvalue() == MSGPACK * 3
+
+
+def test_msgpack_to_mashpack_invalid():
+    # Negative extension types are reserved by msgpack.
+    with pytest.raises(ValueError):
+        msgpack_to_mashpack(b'\xd6\xff\x00\x00\x00\x00')
+    with pytest.raises(ValueError):
+        msgpack_to_mashpack(b'\x92\x01')
@@ -1,5 +1,10 @@
+import collections
+import dataclasses
+import io
 import pytest
-from mashpack import ExtType
+import socket
+from mashpack import ExtType, LazyStr, Raw, packb, unpackb
+from mashpack.exceptions import ExtraData, OutOfData
 
 
 def test_unpack_nested_maps(unpacker):
@@ -22,3 +27,209 @@ def test_pack_and_unpack_large_objects(obj, packer, unpacker):
     data = packer.pack(obj)
     unpacker.feed(data)
     assert unpacker.unpack() == obj
+
+
+def test_query_filters_and_projects_records(packer, unpacker):
+    records = [
+        {'level': 'info', 'ts': 1, 'msg': 'started'},
+        {'msg': 'failed', 'ts': 2, 'level': 'error'},
+        {'level': 'error', 'ts': 3, 'msg': 'crashed', 'extra': [1, 2, 3]},
+        {'ts': 4, 'msg': 'no level'},
+    ]
+    for record in records:
+        unpacker.feed(packer.pack(record))
+
+    results = list(unpacker.query(fields=['msg', 'ts'], where=[('level', '==', 'error'), ('ts', '>=', 2)]))
+    assert results == [{'msg': 'failed', 'ts': 2}, {'ts': 3, 'msg': 'crashed'}]
+
+
+def test_query_without_projection_returns_whole_records(packer, unpacker):
+    records = [{'region': 'us-east', 'n': 1}, {'region': 'eu-west', 'n': 2}, {'region': 'us-west', 'n': 3}]
+    for record in records:
+        unpacker.feed(packer.pack(record))
+
+    assert list(unpacker.query(where=[('region', 'in', {'us-east', 'us-west'})])) == [records[0], records[2]]
+    assert unpacker.tell() == sum(len(packer.pack(record)) for record in records)
+
+
+@pytest.mark.parametrize('read_size', [0, 64])
+def test_query_from_file(packer, unpacker_type, read_size):
+    # Values and keys that are read again span many reads of the file.
+    records = [{'blob': 'x' * (i * 97 % 5000), 1: 2, 'id': i} for i in range(100)]
+    data = b''.join(packer.pack(record) for record in records)
+
+    unpacker = unpacker_type(io.BytesIO(data), read_size=read_size)
+    assert list(unpacker.query(where=[('blob', '>=', '')])) == records
+    unpacker = unpacker_type(io.BytesIO(data), read_size=read_size)
+    assert list(unpacker.query(fields=['id'], where=[('blob', '>=', 'x')])) == [{'id': i} for i in range(1, 100)]
+
+
+@pytest.mark.parametrize('read_size', [0, 16])
+def test_unpack_extensions_from_file(packer_type, unpacker_type, read_size):
+    # Extensions are unpacked in place while the buffer before them is stripped.
+    config = {'name': 'default', 'retries': [1, 2, 4, 8]}
+    objs = ['x' * 5000, [{'id': i, 'name': 'n'} for i in range(50)], ['us-east', 'eu-central'] * 20, [config, config]]
+    packer = packer_type(use_columnar=True, use_dictionary=True, use_refs=True)
+    data = b''.join(packer.pack(obj) for obj in objs) * 3
+
+    unpacker = unpacker_type(io.BytesIO(data), read_size=read_size)
+    assert list(unpacker) == objs * 3
+
+
+@pytest.mark.parametrize('read_size', [0, 16])
+def test_unpack_ref_past_itself(packer, unpacker_type, read_size):
+    # The BIN8 within the BIN that's referenced would end after the reference.
+    data = packer.pack('x' * 5000) + b'\x82\xCE\x04\xCE\x40\x00\x00\xDB\x01\x80\x03' + packer.pack('y' * 100)
+    unpacker = unpacker_type(io.BytesIO(data), read_size=read_size)
+    assert unpacker.unpack() == 'x' * 5000
+    with pytest.raises(ValueError):
+        unpacker.unpack()
+
+
+def test_unpack_lazy_str(packer, unpacker_type):
+    unpacker = unpacker_type(lazy_str=True)
+    data = packer.pack({'name': 'mashpack', 'tags': ['a' * 100, 'b']})
+    unpacker.feed(data)
+    obj = unpacker.unpack()
+
+    assert list(obj.keys()) == ['name', 'tags']
+    assert isinstance(obj['name'], LazyStr)
+    assert obj['name'].data == b'mashpack'
+    assert obj == {'name': 'mashpack', 'tags': ['a' * 100, 'b']}
+    assert packer.pack(obj) == data
+
+
+def test_unpack_raw_fields_pass_through(packer, unpacker_type):
+    unpacker = unpacker_type(raw_fields=['payload'])
+    data = packer.pack({'id': 1, 'payload': {'a': [1, 2, 3], 'b': 'x' * 100}})
+    unpacker.feed(data)
+    obj = unpacker.unpack()
+
+    assert isinstance(obj['payload'], Raw)
+    assert obj['payload'].span == (13, len(data))
+    assert obj['payload'].data == data[13:]
+
+    obj['id'] = 2
+    assert packer.pack(obj) == packer.pack({'id': 2, 'payload': {'a': [1, 2, 3], 'b': 'x' * 100}})
+
+
+def test_unpack_raw(packer, unpacker):
+    unpacker.feed(packer.pack([1, 2]) + packer.pack('abc'))
+    assert unpacker.unpack_raw() == Raw(b'\x82\xa1\xa2', (0, 3))
+    assert unpacker.unpack_raw() == Raw(b'\x43abc', (3, 7))
+
+
+def test_unpack_typed_fixed_width_array(unpacker):
+    unpacker.feed(b'\x82\xC8\x03\xD6\x00\x01\x01\x00\xff\xff\xC8\x02\xC5\x01a\x01b')
+    assert unpacker.unpack() == [[1, 256, 65535], ['a', 'b']]
+
+
+@dataclasses.dataclass(frozen=True)
+class Point:
+    y: int
+    x: int
+
+
+def test_unpack_classes(packer, unpacker_type):
+    # Keys match in their declared order or sorted as packed canonically.
+    unpacker = unpacker_type(classes=[Point])
+    unpacker.feed(packer.pack([{'y': 2, 'x': 1}, {'x': 1, 'y': 2}, {'y': 1, 'z': 2}, {'a': 1, 'b': 2}]))
+    assert unpacker.unpack() == [Point(2, 1), Point(2, 1), {'y': 1, 'z': 2}, {'a': 1, 'b': 2}]
+
+
+def test_unpack_classes_sharing_first_field(packer, unpacker_type):
+    A = collections.namedtuple('A', ['x', 'y'])
+    B = collections.namedtuple('B', ['x', 'z'])
+    unpacker = unpacker_type(io.BytesIO(packer.pack([{'x': 1, 'y': 2}, {'x': 3, 'z': 4}, {'x': 5, 'w': 6}])),
+                             read_size=1, classes=[A, B])
+    a, b, other = unpacker.unpack()
+    assert type(a) is A and a == (1, 2)
+    assert type(b) is B and b == (3, 4)
+    assert other == {'x': 5, 'w': 6}
+
+
+def test_unpack_classes_short_map_at_end_of_file(packer, unpacker_type):
+    @dataclasses.dataclass
+    class Long:
+        long_field_name: int
+
+    unpacker = unpacker_type(io.BytesIO(packer.pack({'a': 1})), classes=[Long])
+    assert unpacker.unpack() == {'a': 1}
+
+
+def test_unpack_schema_names(packer, unpacker_type):
+    unpacker = unpacker_type(schema=('id', 'name'))
+    unpacker.feed(packer.pack([{'id': 1, 'name': 'a'}, {'name': 'b', 'id': 2}, {'id': 3}]))
+    assert unpacker.unpack() == [(1, 'a'), {'name': 'b', 'id': 2}, {'id': 3}]
+    assert unpacker.schema == ('id', 'name')
+
+
+def test_unpack_schema_class(packer, unpacker_type):
+    Record = collections.namedtuple('Record', ['id', 'tags'])
+    unpacker = unpacker_type(schema=Record)
+    unpacker.feed(packer.pack({'id': 1, 'tags': ['a']}))
+    assert unpacker.unpack() == Record(1, ['a'])
+
+
+def test_unpack_schema_infer(packer, unpacker_type):
+    unpacker = unpacker_type(schema='infer')
+    assert unpacker.schema is None
+    data = b''.join(packer.pack({'id': i, 'meta': {'x': i}}) for i in range(3))
+
+    # The schema is inferred once the first map is unpacked completely.
+    unpacker.feed(data[:5])
+    with pytest.raises(OutOfData):
+        unpacker.unpack()
+    unpacker.feed(data[5:])
+    assert list(unpacker) == [(0, {'x': 0}), (1, {'x': 1}), (2, {'x': 2})]
+    assert unpacker.schema == ('id', 'meta')
+
+
+def test_unpack_schema_invalid(unpacker_type):
+    with pytest.raises(ValueError):
+        unpacker_type(schema='id')
+    with pytest.raises(TypeError):
+        unpacker_type(schema=[1, 2])
+
+
+class ReadOnlyFile(object):
+    def __init__(self, data):
+        self._file = io.BytesIO(data)
+
+    def read(self, n):
+        return self._file.read(n)
+
+
+@pytest.mark.parametrize('file_type', [io.BytesIO, ReadOnlyFile])
+def test_unpack_file_reuses_buffer(packer, unpacker_type, file_type):
+    objs = [{'id': i, 'name': 'x' * i} for i in range(500)]
+    data = b''.join(packer.pack(obj) for obj in objs)
+    unpacker = unpacker_type(file_type(data), read_size=64)
+    assert list(unpacker) == objs
+    assert len(unpacker._buffer) < len(data) // 10
+
+
+def test_unpack_socket(packer, unpacker_type):
+    objs = [[i, 'a' * i] for i in range(100)]
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        sender.sendall(b''.join(packer.pack(obj) for obj in objs))
+        sender.shutdown(socket.SHUT_WR)
+        assert list(unpacker_type(receiver, read_size=256)) == objs
+
+
+def test_unpack_feed_compacts_buffer(packer, unpacker):
+    data = packer.pack('x' * 100)
+    for _ in range(100):
+        unpacker.feed(data)
+        assert unpacker.unpack() == 'x' * 100
+    assert len(unpacker._buffer) < 2 * len(data)
+
+
+def test_unpackb_reused_after_errors():
+    with pytest.raises(ExtraData):
+        unpackb(packb(1) + packb(2))
+    with pytest.raises(OutOfData):
+        unpackb(packb('abc')[:2])
+    assert unpackb(packb([1, 'abc'])) == [1, 'abc']
+    assert unpackb(packb({'a': 1}), classes=[Point]) == {'a': 1}